@@ -0,0 +1,79 @@
+'''Reports how much memory the node tree of a large template takes.
+
+Python 2 has no tracemalloc, so the size is measured by walking the tree and adding up
+sys.getsizeof() of every node, its instance dict and the objects it references.
+
+    python benchmarks/memory.py [number of lines]
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hamlpy import hamlpy
+from hamlpy.nodes import RootNode
+
+
+def make_template(lines):
+    haml = ['%html', '  %body']
+    while len(haml) < lines:
+        haml.extend([
+            '    .row',
+            "      %div.col-md-6{'data-id': 'item'}",
+            '        %span.label= item.name',
+            '        %p Some text for #{item.name}',
+            '      - if item.active',
+            '        %a{href: url("detail", item.pk)} Details',
+        ])
+    return '\n'.join(haml)
+
+
+def deep_size(root):
+    seen = set()
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, RootNode):
+            stack.extend(obj.children)
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    if name != 'parent' and hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+        elif isinstance(obj, dict):
+            for key, value in obj.items():
+                if key != 'parent':
+                    stack.append(key)
+                    stack.append(value)
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return total
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    haml_lines = make_template(lines).split('\n')
+
+    compiler = hamlpy.Compiler()
+    root = RootNode()
+    for node in compiler._parse(haml_lines, root):
+        pass
+    parsed = deep_size(root)
+    root.render()
+    rendered = deep_size(root)
+
+    print '%d lines' % len(haml_lines)
+    print 'parsed tree:   %8.1f KB' % (parsed / 1024.0)
+    print 'rendered tree: %8.1f KB' % (rendered / 1024.0)
+
+
+if __name__ == '__main__':
+    main()
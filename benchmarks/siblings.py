@@ -0,0 +1,39 @@
+'''Times rendering a list whose items all remove the whitespace around them with `>`.
+
+    python benchmarks/siblings.py [number of siblings]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hamlpy import hamlpy
+from hamlpy.nodes import RootNode
+
+
+def make_template(siblings):
+    return '\n'.join(['%ul'] + ['  %%li> item %d' % i for i in range(siblings)])
+
+
+def main():
+    siblings = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    haml_lines = make_template(siblings).split('\n')
+
+    root = RootNode()
+    for node in hamlpy.Compiler()._parse(haml_lines, root):
+        pass
+
+    start = time.time()
+    root._render_children()
+    rendered = time.time()
+    root._post_render_children()
+    post_rendered = time.time()
+
+    print '%d siblings' % siblings
+    print 'render:      %.3fs' % (rendered - start)
+    print 'post-render: %.3fs' % (post_rendered - rendered)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''Times importing the compiler, the way `python -X importtime` would on Python 3.
+
+Python 2 has no -X importtime, so a child interpreter replaces __import__ with one that
+times every module it loads and prints the slowest ones. The child runs without
+DJANGO_SETTINGS_MODULE, like the hamlpy command line tool usually does.
+
+    python benchmarks/startup.py [module] [number of runs]
+'''
+import os
+import sys
+import time
+import __builtin__
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def time_imports(module):
+    '''Imports `module`, returning (cumulative seconds, self seconds, name) for each module loaded'''
+    original_import = __builtin__.__import__
+    stack = []
+    timings = []
+
+    def timed_import(name, *args, **kwargs):
+        loaded = len(sys.modules)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if len(sys.modules) > loaded:
+                timings.append((elapsed, elapsed - children, name))
+
+    __builtin__.__import__ = timed_import
+    try:
+        __import__(module)
+    finally:
+        __builtin__.__import__ = original_import
+    return timings
+
+
+def child(module):
+    sys.path.insert(0, ROOT)
+    start = time.time()
+    timings = time_imports(module)
+    total = time.time() - start
+    print '%d modules loaded, %.1f ms' % (len(sys.modules), total * 1000)
+    print '%10s %10s  %s' % ('cumulative', 'self', 'imported as')
+    for cumulative, own, name in sorted(timings, reverse=True)[:25]:
+        print '%8.1fms %8.1fms  %s' % (cumulative * 1000, own * 1000, name)
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2])
+        return
+
+    import subprocess
+    module = sys.argv[1] if len(sys.argv) > 1 else 'hamlpy.hamlpy'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    env = dict(os.environ)
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    env['PYTHONPATH'] = ROOT
+
+    wall = []
+    for i in range(runs):
+        start = time.time()
+        code = subprocess.call([sys.executable, '-c', 'import %s' % module], env=env)
+        wall.append(time.time() - start)
+        if code:
+            print 'importing %s failed' % module
+            return
+    start = time.time()
+    subprocess.call([sys.executable, '-c', 'pass'], env=env)
+    bare = time.time() - start
+
+    print 'import %s: %.1f ms best of %d runs (bare interpreter %.1f ms)' % (module, min(wall) * 1000, runs, bare * 1000)
+    print
+    subprocess.call([sys.executable, os.path.abspath(__file__), '--child', module], env=env)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''Times typo with the built-in "ru" ruleset and with a custom ruleset of many glue words.
+
+For each ruleset the glue words are also applied on their own, with the trie based pattern of
+typo.glue_pattern and with a plain \\b(word|...)\\s alternation like the prepositions used to be.
+
+    python benchmarks/typo.py [number of paragraphs] [number of custom glue words]
+'''
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from hamlpy import typo
+
+
+def make_text(paragraphs, words):
+    random.seed(1)
+    return [u' '.join(random.choice(words) for i in range(60)) + u'.' for j in range(paragraphs)]
+
+
+def make_words(count):
+    random.seed(2)
+    letters = u'абвгдежзиклмнопрстуфхцчшщэюя'
+    return list(set(u''.join(random.choice(letters) for i in range(random.randint(2, 8))) for j in range(count)))
+
+
+def run(name, ruleset, words, texts):
+    start = time.time()
+    alternation = re.compile(ur"\b(%s)\s" % u"|".join(map(re.escape, words)), re.U)
+    alternation_compile = time.time() - start
+    start = time.time()
+    trie = typo.glue_pattern(words)
+    trie_compile = time.time() - start
+
+    timings = []
+    for pattern in (alternation, trie):
+        start = time.time()
+        for text in texts:
+            pattern.sub(u"\\1\u00a0", text)
+        timings.append(time.time() - start)
+
+    start = time.time()
+    for text in texts:
+        ruleset.typo(text)
+    typo_time = time.time() - start
+
+    print '%s ruleset, %d glue words' % (name, len(words))
+    print '  typo:              %.3fs' % typo_time
+    print '  glue, alternation: %.3fs (compiled in %.3fs)' % (timings[0], alternation_compile)
+    print '  glue, trie:        %.3fs (compiled in %.3fs)' % (timings[1], trie_compile)
+
+
+def main():
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    custom_words = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    builtin = typo.get_ruleset('ru')
+    prose = [u'Я', u'и', u'ты', u'в', u'доме', u'из-за', u'угла', u'на', u'столе', u'слово', u'(скобки)', u'т.е.', u'2012', u'г.', u'-']
+    run('ru', builtin, typo.simple_prepositions, make_text(paragraphs, prose))
+
+    words = make_words(custom_words)
+    custom = typo.Ruleset(glue_words=words)
+    run('custom', custom, words, make_text(paragraphs, words[:500] + prose))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,3 @@
-try:
-    import templatize
-except ImportError:
-    pass
+# The makemessages hook in templatize.py needs Django, so it is installed by the template loaders and by
+# HamlPyConfig.ready rather than on import, which keeps the command line tool free of Django
+default_app_config = 'hamlpy.apps.HamlPyConfig'
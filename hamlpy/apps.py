@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class HamlPyConfig(AppConfig):
+    name = 'hamlpy'
+    verbose_name = 'HamlPy'
+
+    def ready(self):
+        # installs the makemessages hook
+        import templatize
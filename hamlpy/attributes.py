@@ -0,0 +1,335 @@
+import re
+
+
+class AttributeParser(object):
+    '''Parses a HAML attribute dictionary in a single pass, without evaluating it.
+
+    Supported entries are
+
+        key: value                  python or ruby style keys: 'key', "key", key, :key =>
+        key: if(condition)          attribute present only if condition is true
+        key: unless(condition)      attribute present only if condition is false
+        key: if(condition, value)   attribute with value present only if condition is true
+        key: tagname(arguments)     value rendered as {% tagname arguments %}
+
+    where a value is a string, a number, None, a (dotted) variable name which is
+    rendered as #{name}, or a list or tuple of those.
+    '''
+
+    WHITESPACE = re.compile(r'\s*')
+    KEY = re.compile(r'[\w-]+')
+    CALL = re.compile(r'(\w+)\(')
+    NAME = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*(?:\.[a-zA-Z_][a-zA-Z0-9_]*)*')
+    NUMBER = re.compile(r'-?(?:\d+(\.\d*)?|(\.)\d+)([eE][-+]?\d+)?(?![\w.])')
+    STRING = re.compile(r'''([uUbB]?)([rR]?)('([^'\\]*(?:\\.[^'\\]*)*)'|"([^"\\]*(?:\\.[^"\\]*)*)")''', re.DOTALL)
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def parse(self):
+        '''Returns the attributes as a dict, followed by conditional, conditional presence
+        and tag call entries as lists of tuples, all in the order they appear in the text'''
+        attributes = {}
+        conditionals = []
+        presences = []
+        tag_calls = []
+
+        self._expect('{')
+        while not self._accept('}'):
+            key = self._key()
+            self._skip_whitespace()
+            call = self._call()
+            if call is None:
+                attributes[key] = self._value()
+            else:
+                name, arguments = call
+                if name in ('if', 'unless'):
+                    check_type = 'if not' if name == 'unless' else 'if'
+                    condition, value = _split_arguments(arguments)
+                    if value is None:
+                        conditionals.append((key, check_type, condition))
+                    else:
+                        presences.append((key, check_type, condition, value))
+                else:
+                    tag_calls.append((key, name, arguments.strip()))
+
+            if not self._accept(','):
+                self._expect('}')
+                break
+
+        self._skip_whitespace()
+        if self.pos != len(self.text):
+            self._error('unexpected text after the closing brace')
+        return attributes, conditionals, presences, tag_calls
+
+    def _key(self):
+        self._skip_whitespace()
+        ruby_symbol = self._peek() == ':'
+        if ruby_symbol:
+            self.pos += 1
+            key = self._match(self.KEY)
+        elif self._peek() in ('"', "'"):
+            key = self._string()
+        else:
+            key = self._match(self.KEY)
+        if key is None:
+            self._error('expected a key')
+
+        self._skip_whitespace()
+        if self.text.startswith('=>', self.pos):
+            self.pos += 2
+        elif not ruby_symbol and self._peek() == ':':
+            self.pos += 1
+        else:
+            self._error('expected : or => after the key')
+        return key
+
+    def _call(self):
+        '''Returns (name, arguments) if the value is a call such as if(...) or url(...)'''
+        match = self.CALL.match(self.text, self.pos)
+        if not match:
+            return None
+        self.pos = match.end()
+        start = self.pos
+        self._skip_balanced(')')
+        return match.group(1), self.text[start:self.pos - 1]
+
+    def _value(self):
+        self._skip_whitespace()
+        char = self._peek()
+        if char in ('[', '('):
+            self.pos += 1
+            items, trailing_comma = self._sequence(']' if char == '[' else ')')
+            if char == '(' and len(items) == 1 and not trailing_comma:
+                # Parenthesised value, not a tuple
+                return items[0]
+            return items if char == '[' else tuple(items)
+
+        value = self._literal()
+        if value is _MISSING:
+            self._error('expected a value')
+        return value
+
+    def _sequence(self, closing):
+        items = []
+        trailing_comma = False
+        self._skip_whitespace()
+        while not self._accept(closing):
+            value = self._literal()
+            if value is _MISSING:
+                self._error('expected a value')
+            items.append(value)
+            trailing_comma = self._accept(',')
+            if not trailing_comma:
+                self._expect(closing)
+                break
+        return items, trailing_comma
+
+    def _literal(self):
+        self._skip_whitespace()
+        char = self._peek()
+        if char in ('"', "'") or (char and char in 'uUbBrR' and self.STRING.match(self.text, self.pos)):
+            value = self._string()
+            # Adjacent string literals are concatenated
+            self._skip_whitespace()
+            while self._peek() and self.STRING.match(self.text, self.pos):
+                value += self._string()
+                self._skip_whitespace()
+            return value
+
+        match = self.NUMBER.match(self.text, self.pos)
+        if match:
+            if match.group(1) or match.group(2) or match.group(3):
+                self.pos = match.end()
+                return float(match.group())
+            # Python 2 literals, so a leading zero means octal
+            try:
+                value = int(match.group(), 0)
+            except ValueError:
+                self._error('invalid octal number %s' % match.group())
+            self.pos = match.end()
+            return value
+
+        name = self._match(self.NAME)
+        if name is not None:
+            return None if name == 'None' else '#{%s}' % name
+        return _MISSING
+
+    def _string(self):
+        match = self.STRING.match(self.text, self.pos)
+        if not match:
+            self._error('unterminated string')
+        self.pos = match.end()
+        unicode_prefix, raw, _, single, double = match.groups()
+        body = single if single is not None else double
+        if raw:
+            return body
+        return _unescape(body, unicode_prefix.lower() == 'u')
+
+    def _skip_balanced(self, closing):
+        '''Moves past the `closing` bracket matching an opening one just before the position'''
+        depth = 1
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char in ('"', "'"):
+                self._string()
+                continue
+            self.pos += 1
+            if char in '([{':
+                depth += 1
+            elif char in ')]}':
+                depth -= 1
+                if depth == 0:
+                    return
+        self._error('missing %s' % closing)
+
+    def _skip_whitespace(self):
+        self.pos = self.WHITESPACE.match(self.text, self.pos).end()
+
+    def _match(self, regex):
+        match = regex.match(self.text, self.pos)
+        if not match:
+            return None
+        self.pos = match.end()
+        return match.group()
+
+    def _peek(self):
+        return self.text[self.pos:self.pos + 1]
+
+    def _accept(self, char):
+        self._skip_whitespace()
+        if self._peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, char):
+        if not self._accept(char):
+            self._error('expected %s' % char)
+
+    def _error(self, message):
+        raise Exception('%s at position %d of %s' % (message, self.pos, self.text))
+
+
+_MISSING = object()
+_ESCAPE = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|[0-7]{1,3}|.)', re.DOTALL)
+_ESCAPES = {'\\': '\\', "'": "'", '"': '"', 'a': '\a', 'b': '\b', 'f': '\f',
+            'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\n': ''}
+
+
+def _unescape(body, unicode_literal):
+    '''Resolves backslash escapes like a python string literal would'''
+    if '\\' not in body:
+        return body
+
+    def replace(match):
+        escape = match.group(1)
+        if escape in _ESCAPES:
+            return _ESCAPES[escape]
+        if escape[0] == 'x':
+            return unichr(int(escape[1:], 16))
+        if escape[0] == 'u' and unicode_literal:
+            return unichr(int(escape[1:], 16))
+        if escape[0] in '01234567':
+            return unichr(int(escape, 8))
+        return '\\' + escape
+    return _ESCAPE.sub(replace, body)
+
+
+def _split_arguments(arguments):
+    '''Splits "condition, value" at the first top-level comma, value is None without one'''
+    depth = 0
+    quote = None
+    for i, char in enumerate(arguments):
+        if quote:
+            if char == quote and arguments[i - 1] != '\\':
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            return arguments[:i].strip(), arguments[i + 1:].strip()
+    return arguments.strip(), None
+
+
+_QUOTED_VALUE = re.compile(r'''^('.+?'|".+?")$''', re.DOTALL)
+
+
+def escape_attribute_quotes(v):
+    '''
+    Escapes quotes with a backslash, except those inside a Django tag
+    '''
+    escaped=[]
+    inside_tag = False
+    for i, _ in enumerate(v):
+        if v[i:i+2] == '{%':
+            inside_tag=True
+        elif v[i:i+2] == '%}':
+            inside_tag=False
+
+        if v[i]=="'" and not inside_tag:
+            escaped.append('\\')
+
+        escaped.append(v[i])
+
+    return ''.join(escaped)
+
+
+def parse_attribute_dictionary(text):
+    '''Returns the attributes dict and the rendered attribute string for an attribute dictionary.
+
+    `id` and `class` are only returned in the dict, the element merges them with the ones
+    from the #id.class shorthand. All other attributes are rendered into the string.
+    '''
+    attributes_dict, conditionals, presences, tag_calls = AttributeParser(text.replace('\n', ' ')).parse()
+
+    attributes = []
+    for k, v in attributes_dict.items():
+        if k != 'id' and k != 'class':
+            if v is None:
+                attributes.append("%s " % (k,))
+            elif isinstance(v, (int, long, float)):
+                attributes.append("%s='%s' " % (k, v))
+            elif isinstance(v, basestring):
+                attributes.append("%s='%s' " % (k, escape_attribute_quotes(v)))
+            else:
+                raise Exception('only `id` and `class` can have multiple values')
+
+    for attrname, check_type, condition in conditionals:
+        attributes.append("{%% %s %s %%} %s{%% endif %%}" % (check_type, condition, attrname))
+
+    for attrname, check_type, condition, value in presences:
+        if _QUOTED_VALUE.match(value):
+            value = escape_attribute_quotes(value[1:-1])
+        else:
+            value = "#{%s}" % value # value is variable
+        if attrname == "class":
+            previous_value = attributes_dict.get("class")
+            if previous_value:
+                attributes_dict["class"] = "%s{%% %s %s %%} %s{%% endif %%}" % (previous_value, check_type, condition, value)
+            else:
+                attributes_dict["class"] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
+        else:
+            if attributes_dict.get(attrname):
+                raise Exception('multiple values are allowed only for `class`')
+            if attrname == "id":
+                attributes_dict[attrname] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
+            else:
+                _append_separated(attributes, "{%% %s %s %%}%s='%s'{%% endif %%}" % (check_type, condition, attrname, value))
+
+    for attrname, tagname, arguments in tag_calls:
+        if attributes_dict.get(attrname):
+            raise Exception('multiple values are allowed only for `class`')
+        _append_separated(attributes, "%s='{%% %s %s %%}'" % (attrname, tagname, arguments))
+
+    return attributes_dict, ''.join(attributes).strip()
+
+
+def _append_separated(attributes, text):
+    if attributes and not attributes[-1].endswith(' '):
+        attributes.append(' ')
+    attributes.append(text)
@@ -0,0 +1,203 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on Windows, writes are still atomic
+    fcntl = None
+
+
+class LRUCache(object):
+    '''Thread-safe mapping that keeps at most `maxsize` entries, evicting the least recently used.
+
+    A `maxsize` of None never evicts, a `maxsize` of 0 disables caching entirely.
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<LRUCache size=%d maxsize=%s hits=%d misses=%d>' % (len(self._data), self.maxsize, self.hits, self.misses)
+
+
+class DiskCache(object):
+    '''Directory of cached strings that can be shared between processes.
+
+    Entries are written atomically (temporary file + rename) so readers never see partial data.
+    Writers and eviction are serialised through a lock file. Entries unused for longer than
+    `max_age` seconds are ignored and the least recently used ones are evicted once the directory
+    holds more than `max_size` bytes.
+    '''
+
+    LOCK_FILE = '.lock'
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024, max_age=None, prune_interval=50):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self._writes = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def make_key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(str(part))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            if self.max_age is not None and time.time() - os.stat(path).st_mtime > self.max_age:
+                return default
+            with open(path, 'rb') as f:
+                value = f.read().decode('utf-8')
+        except (IOError, OSError):
+            return default
+        # Record the use so eviction removes the least recently used entries first. The directory may be
+        # read-only, or the entry pruned by another process since it was read, which does not change the value.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        with self._lock():
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(value.encode('utf-8'))
+                if os.name == 'nt' and os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp_path, path)
+            except:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                self._prune()
+
+    def prune(self):
+        with self._lock():
+            self._prune()
+
+    def clear(self):
+        with self._lock():
+            for path, _ in self._entries():
+                _remove(path)
+
+    def _prune(self):
+        entries = self._entries()
+        now = time.time()
+        total = 0
+        # Newest first, so that everything past the size budget is the least recently used
+        for path, st in sorted(entries, key=lambda entry: entry[1].st_mtime, reverse=True):
+            if self.max_age is not None and now - st.st_mtime > self.max_age:
+                _remove(path)
+                continue
+            total += st.st_size
+            if self.max_size is not None and total > self.max_size:
+                _remove(path)
+
+    def _entries(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename == self.LOCK_FILE or filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    entries.append((path, os.stat(path)))
+                except OSError:
+                    pass
+        return entries
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.directory, self.LOCK_FILE), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,199 @@
+'''Ways of running the external compilers behind the :coffee, :sass and :scss filters.
+
+A backend's `compile(blocks)` takes a list of (args, source) blocks, where `args` is the
+command line the filter would run for that block alone, and returns an (output, error)
+pair for each one.
+'''
+import sys
+import json
+import time
+import threading
+import subprocess
+from Queue import Queue, Empty
+
+
+def _run(args, source, timeout=None):
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  stdin=subprocess.PIPE)
+    if timeout is None:
+        return proc.communicate(source)
+
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            # Exited in the meantime
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output, err = proc.communicate(source)
+    finally:
+        timer.cancel()
+    if timed_out:
+        return '', '%s timed out after %s seconds' % (args[0], timeout)
+    return output, err
+
+
+class SubprocessBackend(object):
+    '''Starts the compiler once for every block, one block after the other'''
+
+    def compile(self, blocks):
+        return [_run(args, source) for args, source in blocks]
+
+    def close(self):
+        pass
+
+
+class ConcurrentBackend(object):
+    '''Starts the compiler once for every block, running up to `max_processes` of them at once.
+    A block still compiling after `timeout` seconds is stopped and fails with a timeout error.'''
+
+    def __init__(self, max_processes=4, timeout=None):
+        self.max_processes = max_processes
+        self.timeout = timeout
+
+    def compile(self, blocks):
+        if len(blocks) < 2 or self.max_processes < 2:
+            return [_run(args, source, self.timeout) for args, source in blocks]
+
+        results = [None] * len(blocks)
+        errors = []
+        pending = Queue()
+        for i in range(len(blocks)):
+            pending.put(i)
+
+        def work():
+            while not errors:
+                try:
+                    i = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = _run(blocks[i][0], blocks[i][1], self.timeout)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work) for i in range(min(self.max_processes, len(blocks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # e.g. the compiler is not installed, raised like the serial backends do
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def close(self):
+        pass
+
+
+class WorkerBackend(object):
+    '''Sends the blocks to one long-lived worker process per compiler instead of starting
+    the compiler for every block.
+
+    `workers` maps a filter command line, e.g. ('coffee', '-sc') or 'coffee -sc', to the command
+    that starts its worker. Commands without a worker fall back to `fallback`, one process per block.
+
+    A worker reads one JSON object per line on stdin, {"source": "..."}, and answers each
+    with one line on stdout, {"output": "...", "error": "..."}, where "error" is empty or
+    missing if the block compiled. A worker that dies, takes longer than `timeout` seconds to
+    answer or answers anything else is stopped and started again for the next block, and the
+    block it failed on is compiled by `fallback` instead.
+    '''
+
+    def __init__(self, workers, fallback=None, timeout=60):
+        self.workers = dict((_command_key(args), list(command)) for args, command in workers.items())
+        self.fallback = fallback or SubprocessBackend()
+        self.timeout = timeout
+        self._processes = {}
+        # One lock per worker, so threads only wait for each other when they use the same compiler
+        self._locks = dict((tuple(command), threading.Lock()) for command in self.workers.values())
+
+    def compile(self, blocks):
+        results = [None] * len(blocks)
+        others = []
+        for i, (args, source) in enumerate(blocks):
+            command = self.workers.get(_command_key(args))
+            if command is not None:
+                with self._locks[tuple(command)]:
+                    results[i] = self._request(command, source)
+            if results[i] is None:
+                others.append(i)
+        if others:
+            for i, result in zip(others, self.fallback.compile([blocks[i] for i in others])):
+                results[i] = result
+        return results
+
+    def _request(self, command, source):
+        '''Returns the (output, error) of the worker, None if it failed'''
+        if isinstance(source, str):
+            source = source.decode('utf-8')
+        timer = None
+        try:
+            proc = self._process(command)
+            if self.timeout is not None:
+                # Makes the readline below return once the worker is killed
+                timer = threading.Timer(self.timeout, _kill, [proc])
+                timer.start()
+            proc.stdin.write(json.dumps({'source': source}) + '\n')
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+            if not line:
+                raise IOError('the worker exited')
+            response = json.loads(line)
+            if not isinstance(response, dict):
+                raise ValueError('the worker did not answer with an object')
+            output = response.get('output', '')
+            error = response.get('error') or ''
+            if not isinstance(output, basestring) or not isinstance(error, basestring):
+                raise ValueError('the worker did not answer with strings')
+        except (IOError, OSError, ValueError):
+            self._stop(command)
+            return None
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return output.encode('utf-8'), error.encode('utf-8')
+
+    def _process(self, command):
+        key = tuple(command)
+        proc = self._processes.get(key)
+        if proc is None or proc.poll() is not None:
+            proc = self._processes[key] = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                                           stdout=subprocess.PIPE, close_fds=True)
+        return proc
+
+    def _stop(self, command):
+        proc = self._processes.pop(tuple(command), None)
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def close(self, timeout=5):
+        '''Stops the workers, killing those still running `timeout` seconds after their stdin closed'''
+        for command, lock in self._locks.items():
+            with lock:
+                proc = self._processes.pop(command, None)
+                if proc is not None and proc.poll() is None:
+                    proc.stdin.close()
+                    deadline = time.time() + timeout
+                    while proc.poll() is None and time.time() < deadline:
+                        time.sleep(0.01)
+                    if proc.poll() is None:
+                        _kill(proc)
+                        proc.wait()
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        # Exited in the meantime
+        pass
+
+
+def _command_key(args):
+    return tuple(args.split()) if isinstance(args, basestring) else tuple(args)
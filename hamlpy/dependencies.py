@@ -0,0 +1,96 @@
+import os
+import re
+import threading
+
+from nodes import TagNode, FilterNode
+
+# Django tags that make a template depend on another one
+DEPENDENCY_TAGS = ('extends', 'include')
+
+# Quoted template name at the start of the tag arguments; names held in variables are not known until rendering
+TEMPLATE_NAME = re.compile(r'''^(['"])(.+?)\1''')
+
+
+def template_key(name):
+    '''Name under which a template is kept in a DependencyGraph, the same for "base.haml" and "base.html"'''
+    return os.path.splitext(name.replace(os.sep, '/'))[0]
+
+
+def dependency_of(node):
+    '''Returns the name of the template `node` extends or includes, or None'''
+    if not isinstance(node, TagNode) or node.tag_name not in DEPENDENCY_TAGS:
+        return None
+    # Lines inside a filter are plain text
+    if isinstance(node.parent, FilterNode):
+        return None
+    match = TEMPLATE_NAME.match(node.tag_statement[len(node.tag_name):].strip())
+    return match.group(2) if match else None
+
+
+def find_dependencies(nodes):
+    '''Returns the names of the templates the parsed `nodes` extend or include, in order'''
+    names = []
+    for node in nodes:
+        name = dependency_of(node)
+        if name is not None and name not in names:
+            names.append(name)
+    return names
+
+
+class DependencyGraph(object):
+    '''Which templates extend or include which, with a reverse index to find all templates
+    affected by a change to a shared base template or partial.
+
+    Templates are identified by template_key() of their name.
+    '''
+
+    def __init__(self):
+        self._dependencies = {}
+        self._dependents = {}
+        self._lock = threading.Lock()
+
+    def update(self, name, dependencies):
+        '''Records that template `name` extends or includes `dependencies`, replacing what was known'''
+        name = template_key(name)
+        dependencies = frozenset(template_key(dependency) for dependency in dependencies)
+        with self._lock:
+            self._unlink(name)
+            if dependencies:
+                self._dependencies[name] = dependencies
+                for dependency in dependencies:
+                    self._dependents.setdefault(dependency, set()).add(name)
+
+    def remove(self, name):
+        with self._lock:
+            self._unlink(template_key(name))
+
+    def dependencies(self, name):
+        '''Templates `name` extends or includes directly'''
+        with self._lock:
+            return set(self._dependencies.get(template_key(name), ()))
+
+    def dependents(self, name):
+        '''Templates that extend or include `name` directly'''
+        with self._lock:
+            return set(self._dependents.get(template_key(name), ()))
+
+    def affected(self, name):
+        '''Templates that extend or include `name` directly or through other templates'''
+        affected = set()
+        with self._lock:
+            stack = [template_key(name)]
+            while stack:
+                for dependent in self._dependents.get(stack.pop(), ()):
+                    if dependent not in affected:
+                        affected.add(dependent)
+                        stack.append(dependent)
+        affected.discard(template_key(name))
+        return affected
+
+    def _unlink(self, name):
+        for dependency in self._dependencies.pop(name, ()):
+            dependents = self._dependents.get(dependency)
+            if dependents is not None:
+                dependents.discard(name)
+                if not dependents:
+                    del self._dependents[dependency]
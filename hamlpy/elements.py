@@ -1,23 +1,7 @@
 import re
-import sys
-from types import NoneType
 
-
-class ObjectHack(object):
-    
-    def __init__(self, name):
-        self._name = name
-    
-    def __getattr__(self, name):
-        return ObjectHack("%s.%s" % (self._name, name))
-
-    def __repr__(self):
-        return "<ObjectHack %s>" % self._name
-
-class LocalsHack(dict):
-
-    def __getitem__(self, name):
-        return ObjectHack(name)
+from cache import LRUCache
+from attributes import parse_attribute_dictionary, escape_attribute_quotes
 
 
 class Element(object):
@@ -41,16 +25,13 @@ class Element(object):
     (?P<inline>[^\w\.#\{].*)?
     """, re.X|re.MULTILINE|re.DOTALL)
 
-    _ATTRIBUTE_KEY_REGEX = r'(?P<key>[a-zA-Z_][a-zA-Z0-9_-]*)'
-    #Single and double quote regexes from: http://stackoverflow.com/a/5453821/281469
-    _SINGLE_QUOTE_STRING_LITERAL_REGEX = r"'([^'\\]*(?:\\.[^'\\]*)*)'"
-    _DOUBLE_QUOTE_STRING_LITERAL_REGEX = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
-    _ATTRIBUTE_VALUE_REGEX = r'(?P<val>\d+|None(?![A-Za-z0-9_])|%s|%s)'%(_SINGLE_QUOTE_STRING_LITERAL_REGEX, _DOUBLE_QUOTE_STRING_LITERAL_REGEX)
-
-    RUBY_HAML_REGEX = re.compile(r'(:|\")%s(\"|) =>'%(_ATTRIBUTE_KEY_REGEX))
-    ATTRIBUTE_REGEX = re.compile(r'(?P<pre>\{\s*|,\s*)%s:\s*%s'%(_ATTRIBUTE_KEY_REGEX, _ATTRIBUTE_VALUE_REGEX))
     DJANGO_VARIABLE_REGEX = re.compile(r'^\s*=\s(?P<variable>[a-zA-Z_][a-zA-Z0-9._-]*)\s*$')
 
+    # Parsed element heads, shared by all compilers. Cached attributes_dict values must not be modified.
+    head_cache = LRUCache(maxsize=1024)
+    HEAD_FIELDS = ('tag', 'id', 'classes', 'attributes', 'attributes_dict', 'self_close',
+                   'nuke_inner_whitespace', 'nuke_outer_whitespace', 'django_variable')
+
 
     def __init__(self, haml):
         self.haml = haml
@@ -66,21 +47,39 @@ class Element(object):
         self._parse_haml()
         
     def _parse_haml(self):
-        split_tags = self.HAML_REGEX.search(self.haml).groupdict('')
-        
-        self.attributes_dict = self._parse_attribute_dictionary(split_tags.get('attributes'))
+        match = self.HAML_REGEX.search(self.haml)
+        split_tags = match.groupdict('')
+
+        # Everything before the inline content only depends on the head, so it is parsed once per distinct head
+        head = self.haml[:match.start('inline')] if match.group('inline') is not None else self.haml[:match.end()]
+        parsed = self.head_cache.get(head)
+        if parsed is None:
+            self._parse_head(split_tags)
+            self.head_cache.set(head, tuple(getattr(self, field) for field in self.HEAD_FIELDS))
+        else:
+            for field, value in zip(self.HEAD_FIELDS, parsed):
+                setattr(self, field, value)
+        self.inline_content = split_tags.get('inline').strip()
+
+    def _parse_head(self, split_tags):
+        if split_tags.get('attributes'):
+            self.attributes_dict = self._parse_attribute_dictionary(split_tags.get('attributes'))
+            self.id = self._parse_id(split_tags.get('id'))
+            self.classes = ('%s %s' % (split_tags.get('class').lstrip(self.CLASS).replace('.', ' '), self._parse_class_from_attributes_dict())).strip()
+        else:
+            # No attribute dictionary, id and classes come from the shorthand alone
+            self.attributes_dict = {}
+            self.id = split_tags.get('id').strip(self.ID).lstrip('_')
+            self.classes = split_tags.get('class').lstrip(self.CLASS).replace('.', ' ').strip()
         self.tag = split_tags.get('tag').strip(self.ELEMENT) or 'div'
-        self.id = self._parse_id(split_tags.get('id'))
-        self.classes = ('%s %s' % (split_tags.get('class').lstrip(self.CLASS).replace('.', ' '), self._parse_class_from_attributes_dict())).strip()
         self.self_close = split_tags.get('selfclose') or self.tag in self.self_closing_tags
         self.nuke_inner_whitespace = split_tags.get('nuke_inner_whitespace') != ''
         self.nuke_outer_whitespace = split_tags.get('nuke_outer_whitespace') != ''
         self.django_variable = split_tags.get('django') != ''
-        self.inline_content = split_tags.get('inline').strip()
 
     def _parse_class_from_attributes_dict(self):
         clazz = self.attributes_dict.get('class', '')
-        if not isinstance(clazz, str):
+        if not isinstance(clazz, basestring):
             clazz = ''
             for one_class in self.attributes_dict.get('class'):
                 clazz += ' '+one_class
@@ -96,7 +95,7 @@ class Element(object):
     def _parse_id_dict(self, id_dict):
         text = ''
         id_dict = self.attributes_dict.get('id')
-        if isinstance(id_dict, str):
+        if isinstance(id_dict, basestring):
             text = '_'+id_dict
         else:
             text = ''
@@ -104,137 +103,16 @@ class Element(object):
                 text += '_'+one_id
         return text
 
-    def _escape_attribute_quotes(self,v):
-        '''
-        Escapes quotes with a backslash, except those inside a Django tag
-        '''
-        escaped=[]
-        inside_tag = False
-        for i, _ in enumerate(v):
-            if v[i:i+2] == '{%':
-                inside_tag=True
-            elif v[i:i+2] == '%}':
-                inside_tag=False
-
-            if v[i]=="'" and not inside_tag:
-                escaped.append('\\')
-
-            escaped.append(v[i])
-
-        return ''.join(escaped)
+    def _escape_attribute_quotes(self, v):
+        return escape_attribute_quotes(v)
 
     def _parse_attribute_dictionary(self, attribute_dict_string):
-        if isinstance(attribute_dict_string, unicode):
-            attribute_dict_string = attribute_dict_string.encode("utf-8")
         attributes_dict = {}
         if (attribute_dict_string):
-            attribute_dict_string = attribute_dict_string.replace('\n', ' ')
             try:
-
-                # grab conditional attributes
-                # conditional match is:
-                #  attrname: if(condition)
-                #  attrname: unless(condition)
-                # means `attrname` will present only if `condition` evaluates to `True`
-                # or `False` for unless case
-                # useful for attributes like "checked", "required" etc
-                conditional_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(if|unless)\(\s*([\w=\s\.]+?)\s*\)", attribute_dict_string)
-                # remove conditional matches from attribute string
-                attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*(?:if|unless)\(\s*[\w=\s\.]+?\s*\)\s*,?", "\\1", attribute_dict_string)
-
-                # grab conditional presence attributes
-                # conditional presence is:
-                #  attrname: if(condition, value)
-                #  attrname: unless(condition, value)
-                # means `attrname` will present and have `value` only if `condition` evaluates to `True`
-                # of `False` for unless case
-                # useful for adding "class" and "id"
-                conditional_presence_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(if|unless)\(\s*([\w=\s\.]+?)\s*,\s*(.+?)\s*\)", attribute_dict_string)
-                # remove conditional presence matches from attribute string
-                attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*(?:if|unless)\(\s*[\w=\s\.]+\s*,\s*.+?\s*\)\s*,?", "\\1", attribute_dict_string)
-
-                # grab tag call attributes
-                # tag call attribute is:
-                #   attrname: tagname(arguments)
-                # will render to attrname='{% tagname arguments %}'
-                # useful for "href" attributes
-                tag_call_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(\w+)\(\s*(.+?)\s*\)\s*[\},]", attribute_dict_string)
-                # remove tag call matches from attribute string
-                attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*\w+\(\s*.+?\s*\)\s*,?", "\\1", attribute_dict_string)
-
-                # converting all allowed attributes to python dictionary style
-
-                # Replace Ruby-style HAML with Python style
-                attribute_dict_string = re.sub(self.RUBY_HAML_REGEX, '"\g<key>":',attribute_dict_string)
-                # Put double quotes around key
-                attribute_dict_string = re.sub(self.ATTRIBUTE_REGEX, '\g<pre>"\g<key>":\g<val>', attribute_dict_string)
-                # Parse string as dictionary
-
-                # use hacked locals to allow literal django variables as values
-                attributes_dict = eval(attribute_dict_string, LocalsHack())
-                for k, v in attributes_dict.items():
-                    if isinstance(k, ObjectHack):
-                        k = k._name # we assume non-variable keys
-                    if isinstance(v, ObjectHack):
-                        v = '#{%s}' % v._name
-                    attributes_dict[k] = v
-                    if k != 'id' and k != 'class':
-                        if isinstance(v, NoneType):
-                            self.attributes += "%s " % (k,)
-                        elif isinstance(v, int) or isinstance(v, float):
-                            self.attributes += "%s='%s' " % (k, v)
-                        else:
-                            v = v.decode('utf-8')
-                            self.attributes += "%s='%s' " % (k, self._escape_attribute_quotes(v))
-
-                # append conditional attributes
-                for attrname, check_type, condition in conditional_matches:
-                    if check_type == "unless":
-                        check_type = "if not"
-                    self.attributes += "{%% %s %s %%} %s{%% endif %%}" % (check_type, condition, attrname)
-
-                # append conditional presence attributes
-                for attrname, check_type, condition, value in conditional_presence_matches:
-                    if check_type == "unless":
-                        check_type = "if not"
-                    if re.compile(r"^'.+?'$", re.U).match(value) or re.compile(r'^".+?"$', re.U).match(value):
-                        value = self._escape_attribute_quotes(value[1:-1])
-                    else:
-                        value = "#{%s}" % value # value is variable
-                    if attrname == "class":
-                        previous_value = attributes_dict.get("class")
-                        if previous_value:
-                            attributes_dict["class"] = "%s{%% %s %s %%} %s{%% endif %%}" % (previous_value, check_type, condition, value)
-                        else:
-                            attributes_dict["class"] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
-                    else:
-                        if attributes_dict.get(attrname):
-                            raise Exception('multiple values are allowed only for `class`')
-                        if attrname == "id":
-                            attributes_dict[attrname] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
-                        else:
-                            if not self.attributes.endswith(" "):
-                                self.attributes += " "
-                            self.attributes += "{%% %s %s %%}%s='%s'{%% endif %%}" % (check_type, condition, attrname, value)
-
-                # append tag call attributes
-                for attrname, tagname, arguments in tag_call_matches:
-                    value = "{%% %s %s %%}" % (tagname, arguments)
-                    if attrname is "class":
-                        previous_value = attributes_dict.get("class")
-                        if previous_value:
-                            attributes_dict["class"] = "%s %s" % (previous_value, value)
-                        else:
-                            attributes_dict["class"] = value
-                    else:
-                        if attributes_dict.get(attrname):
-                            raise Exception('multiple values are allowed only for `class`')
-                        if not self.attributes.endswith(" "):
-                            self.attributes += " "
-                        self.attributes += "%s='%s'" % (attrname, value)
-
-                self.attributes = self.attributes.strip()
+                attributes_dict, attributes = parse_attribute_dictionary(attribute_dict_string)
             except Exception, e:
                 raise Exception('failed to decode: %s'%attribute_dict_string)
+            self.attributes = ('%s %s' % (self.attributes, attributes)).strip()
 
         return attributes_dict
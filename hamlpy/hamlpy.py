@@ -1,33 +1,170 @@
 #!/usr/bin/env python
-from nodes import RootNode, FilterNode, HamlNode, create_node
+from nodes import RootNode, StreamRootNode, FilterNode, HamlNode, CompilerNode, MarkdownFilterNode, create_node, compiler_backend, filter_setting, filter_errors, filters_fingerprint
+from compilers import ConcurrentBackend
+from dependencies import find_dependencies, dependency_of
 from optparse import OptionParser
 import sys
+import json
+import re
 
+VERSION = '0.82.2'
 VALID_EXTENSIONS=['haml', 'hamlpy']
 
+def _markdown_extensions():
+    return repr(filter_setting('markdown_extensions', MarkdownFilterNode.extensions))
+
+def _compiler_backend():
+    backend = filter_setting('backend', CompilerNode.backend)
+    return '%s %r' % (type(backend).__name__, sorted(getattr(backend, 'workers', {}).items()))
+
+def _typo_rulesets():
+    import typo
+    return typo.rulesets_fingerprint()
+
+_library_versions = []
+
+def _filter_library_versions():
+    # Imported once per process, and only by compilers that use a cache
+    if not _library_versions:
+        for name in ('pygments', 'markdown'):
+            try:
+                module = __import__(name)
+            except ImportError:
+                _library_versions.append((name, None))
+            else:
+                _library_versions.append((name, getattr(module, '__version__', None)))
+    return repr(_library_versions)
+
+# Functions describing what else than the template and the options the HTML depends on, their
+# results are part of the cache keys of Compiler(cache=...). Append to it for other inputs.
+cache_key_parts = [_markdown_extensions, _compiler_backend, _typo_rulesets, filters_fingerprint, _filter_library_versions]
+
 class Compiler:
+    def __init__(self, cache=None):
+        # Optional hamlpy.cache.DiskCache shared with other processes
+        self.cache = cache
+        # Names of the templates the last processed template extends or includes
+        self.dependencies = []
+        # Whether an external filter of the last processed template failed, its HTML then
+        # shows the error message and is not cached
+        self.failed = False
+
     def process(self, raw_text, options=None):
         split_text = raw_text.split('\n')
         return self.process_lines(split_text, options)
 
     def process_lines(self, haml_lines, options=None):
+        if self.cache is None:
+            return self._process_lines(haml_lines, options)
+
+        key = self._cache_key(haml_lines, options)
+        entry = self.cache.get(key)
+        if entry is not None:
+            try:
+                entry = json.loads(entry)
+                output, self.dependencies = entry['html'], entry['dependencies']
+            except (ValueError, KeyError, TypeError):
+                # Written by an older version, compiled again below
+                pass
+            else:
+                self.failed = False
+                return output
+
+        output = self._process_lines(haml_lines, options)
+        if not self.failed:
+            self.cache.set(key, json.dumps({'html': output, 'dependencies': self.dependencies}))
+        return output
+
+    def _cache_key(self, haml_lines, options=None):
+        options_key = repr(sorted(vars(options).items())) if options else ''
+        return self.cache.make_key('\n'.join(haml_lines), VERSION, options_key, *[part() for part in cache_key_parts])
+
+    def process_concurrent(self, raw_text, options=None, max_processes=4, timeout=None):
+        '''Like process(), but the :coffee, :sass and :scss blocks of the template are compiled
+        by up to `max_processes` compiler processes at once. A block that takes longer than
+        `timeout` seconds is rendered with the filter's error message. The output is otherwise
+        the same as process(raw_text).
+        '''
+        with compiler_backend(ConcurrentBackend(max_processes, timeout)):
+            return self.process(raw_text, options)
+
+    def process_stream(self, readable, writable=None, options=None):
+        '''Compiles HAML read lazily from `readable`, a file or any other iterable of lines.
+
+        The HTML of a top-level node is produced as soon as a following line at column 0
+        closes it, so memory use is bounded by the largest top-level subtree instead of the
+        whole template. The chunks are written to `writable` if given, otherwise an iterator
+        over them is returned. The output is the same as process(readable.read()).
+        '''
+        chunks = self._iter_stream(_split_lines(readable), options)
+        if writable is None:
+            return chunks
+        for chunk in chunks:
+            writable.write(chunk)
+
+    def _iter_stream(self, haml_lines, options=None):
+        if options and options.debug_tree:
+            yield self._process_lines(haml_lines, options)
+            return
+
+        pending = []
+        root = StreamRootNode(pending.append)
+        self.dependencies = []
+        for node in self._parse(haml_lines, root):
+            dependency = dependency_of(node)
+            if dependency is not None and dependency not in self.dependencies:
+                self.dependencies.append(dependency)
+            if pending:
+                for chunk in pending:
+                    yield chunk
+                del pending[:]
+        root.finish()
+        for chunk in pending:
+            yield chunk
+
+    def _process_lines(self, haml_lines, options=None):
         root = RootNode()
+        self.dependencies = find_dependencies(self._parse(haml_lines, root))
+
+        if options and options.debug_tree:
+            self.failed = False
+            return root.debug_tree()
+        with filter_errors() as errors:
+            html = root.render()
+        self.failed = bool(errors)
+        return html
+
+    def _parse(self, haml_lines, root):
+        '''Builds the node tree under `root`, yielding every node once it is added.
+
+        `stack` holds the open nodes from the root down to the last node added, each one
+        the last child of the one before it, so their indentation never decreases. A new
+        node closes everything above its parent, which is found from the top of the stack
+        instead of walking down from the root for every line.
+        '''
+        stack = [root]
         line_iter = iter(haml_lines)
 
         haml_node=None
         for line_number, line in enumerate(line_iter):
             node_lines = line
 
-            if not root.parent_of(HamlNode(line)).inside_filter_node():
-                if line.count('{') - line.count('}') == 1:
+            top = stack[-1]
+            inside_filter = isinstance(top, FilterNode) and len(line) - len(line.lstrip()) > top.indentation
+            if not inside_filter:
+                braces = BraceTracker()
+                if braces.feed(line) > 0:
                     start_multiline=line_number # For exception handling
+                    node_lines = [line]
 
-                    while line.count('{') - line.count('}') != -1:
+                    while braces.depth > 0:
                         try:
                             line = line_iter.next()
                         except StopIteration:
                             raise Exception('No closing brace found for multi-line HAML beginning at line %s' % (start_multiline+1))
-                        node_lines += line
+                        node_lines.append(line)
+                        braces.feed(line)
+                    node_lines = ''.join(node_lines)
 
             # Blank lines
             if haml_node is not None and len(node_lines.strip()) == 0:
@@ -35,12 +172,87 @@ class Compiler:
             else:
                 haml_node = create_node(node_lines)
                 if haml_node:
-                    root.add_node(haml_node)
-                
-        if options and options.debug_tree:
-            return root.debug_tree()
-        else:
-            return root.render()
+                    self._add_node(stack, haml_node)
+                    yield haml_node
+
+    def _add_node(self, stack, node):
+        # The deepest open node indented less than `node` contains it (the root is at -2)
+        index = len(stack) - 1
+        while stack[index].indentation >= node.indentation:
+            index -= 1
+        # Nodes at the same indentation contain it only if they accept it (if/else, for/empty)
+        while (index + 1 < len(stack) and stack[index + 1].indentation == node.indentation
+               and stack[index + 1].should_contain(node)):
+            index += 1
+        del stack[index + 1:]
+
+        parent = stack[index]
+        parent.add_child(node)
+        # Children of filter nodes are plain text, nothing can be nested inside them
+        if not isinstance(parent, FilterNode):
+            stack.append(node)
+
+# The element head (%tag, .class, #id) before the { of an attribute dictionary
+ATTRIBUTE_DICT_HEAD = re.compile(r'\s*(?:%\w+(?::\w+)?|[#.][\w.-]+)+$')
+
+class BraceTracker(object):
+    '''Tracks how many braces are open over one or more lines.
+
+    Braces inside string literals of an attribute dictionary and inside #{...}/={...} inline
+    variables outside of one are not counted. Quotes anywhere else, such as in plain text or
+    inline scripts, are ordinary text and braces there are simply counted.
+    '''
+    def __init__(self):
+        self.depth = 0
+        self.quote = None
+        self.in_dict = False
+
+    def feed(self, line):
+        if self.quote is None and '{' not in line and '}' not in line:
+            return self.depth
+
+        depth = self.depth
+        quote = self.quote
+        in_dict = self.in_dict
+        i = 0
+        length = len(line)
+        while i < length:
+            c = line[i]
+            if quote:
+                if c == '\\':
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif c == '{':
+                if depth <= 0 and i > 0 and line[i-1] in '#=':
+                    # Inline variable, continue after its closing brace
+                    end = line.find('}', i)
+                    i = length if end == -1 else end
+                else:
+                    if depth == 0:
+                        in_dict = ATTRIBUTE_DICT_HEAD.match(line, 0, i) is not None
+                    depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth <= 0:
+                    in_dict = False
+            elif in_dict and (c == '"' or c == "'"):
+                quote = c
+            i += 1
+
+        self.depth = depth
+        self.quote = quote
+        self.in_dict = in_dict
+        return depth
+
+def _split_lines(readable):
+    '''Yields the lines of `readable` without line endings, the same way str.split('\\n') would'''
+    line = ''
+    for line in readable:
+        yield line[:-1] if line.endswith('\n') else line
+    # A trailing newline (or empty input) leaves an empty last line
+    if line.endswith('\n') or line == '':
+        yield ''
 
 def convert_files():
     import sys
@@ -49,10 +261,22 @@ def convert_files():
     parser = OptionParser()
     parser.add_option("-d", "--debug-tree", dest="debug_tree",
     action="store_true", help="Print the generated tree instead of the HTML")
+    parser.add_option("-s", "--stream", dest="stream",
+    action="store_true", help="Write the HTML while reading the input instead of reading the whole file first")
+    parser.add_option("--markdown-extension", dest="markdown_extensions", action="append", default=[],
+    metavar="NAME", help="Use this Markdown extension in :markdown blocks, can be given several times")
     (options, args) = parser.parse_args()
+    MarkdownFilterNode.extensions = options.markdown_extensions
 
     if len(args) < 1:
         print "Specify the input file as the first argument."
+    elif options.stream:
+        infile = codecs.open(args[0], 'r', encoding='utf-8')
+        if len(args) == 2:
+            outfile = codecs.open(args[1], 'w', encoding='utf-8')
+        else:
+            outfile = codecs.getwriter('utf-8')(sys.stdout)
+        Compiler().process_stream(infile, outfile, options=options)
     else: 
         infile = args[0]
         haml_lines = codecs.open(infile, 'r', encoding='utf-8').read().splitlines()
@@ -2,21 +2,59 @@
 # Author: Christian Stefanescu (st.chris@gmail.com)
 #
 # Watch a folder for files with the given extensions and call the HamlPy
-# compiler if the modified time has changed since the last check.
+# compiler when they change. Uses inotify where available and falls back to
+# checking the modified times every few seconds.
 from time import gmtime, strftime
+from optparse import OptionParser
 import sys
-import codecs
 import os
 import os.path
 import time
+import json
+import signal
+import hashlib
+import tempfile
+import multiprocessing
+from itertools import izip
 import hamlpy
+import inotify
+from cache import DiskCache
+from dependencies import DependencyGraph, template_key
+from nodes import CompilerNode
 
-CHECK_INTERVAL = 3          # in seconds
+try:
+    # Backport of os.scandir for Python 2
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+CHECK_INTERVAL = 3          # in seconds, when polling
 DEBUG = False               # print file paths when a file is compiled
+POOL_WAIT = 24 * 60 * 60    # in seconds, longest wait for a template compiled by the process pool
+
+# Events that make the event-driven watcher look at a directory entry
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE |
+              inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
 
 # dict of compiled files [fullpath : timestamp]
 compiled = dict()
 
+# Build manifest of each destination folder [destination : Manifest]
+manifests = dict()
+
+# Directory listings, reused until the directory changes [path : ((mtime, nlink, size), listed at, subdirectories, files)]
+listings = dict()
+
+# Directory mtimes may only have a resolution of 1 s (ext3, HFS+, some NFS), so a file created in the same tick as a
+# listing leaves the mtime unchanged. Listings taken this many seconds or less after the mtime are not reused.
+LISTING_MTIME_SLACK = 2
+
+# Which templates extend or include which, by name relative to the watch folder
+dependency_graph = DependencyGraph()
+
+# Source of every template seen so far [name : fullpath]
+template_paths = dict()
+
 def watched_extension(extension):
     """Return True if the given extension is one of the watched extensions"""
     for ext in hamlpy.VALID_EXTENSIONS:
@@ -24,66 +62,345 @@ def watched_extension(extension):
             return True
     return False
 
+def _is_template(filename):
+    # Ignore filenames starting with ".#" for Emacs compatibility
+    return watched_extension(filename) and not filename.startswith('.#')
+
 def watch_folder():
     """Main entry point. Expects one or two arguments (the watch folder + optional destination folder)."""
-    argv_len = len(sys.argv)
-    if argv_len in (2, 3):
-        folder = os.path.realpath(sys.argv[1])
-        destination = os.path.realpath(argv_len == 3 and os.path.realpath(sys.argv[2]) or folder)
-        
-        print "Watching %s at refresh interval %s seconds" % (folder,CHECK_INTERVAL)
-        while True:
-            try:
-                _watch_folder(folder, destination)
-                time.sleep(CHECK_INTERVAL)
-            except KeyboardInterrupt:
-                # allow graceful exit (no stacktrace output)
-                sys.exit(0)
-                pass
+    parser = OptionParser(usage="%prog <watch_folder> [destination_folder]")
+    parser.add_option("--cache-dir", dest="cache_dir",
+    help="Reuse compiled templates stored in this directory (shared with other processes)")
+    parser.add_option("--poll", dest="poll", action="store_true", default=False,
+    help="Check for changes every %s seconds instead of waiting for file system events" % CHECK_INTERVAL)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+    help="Compile up to JOBS templates at once when several have changed, e.g. on startup")
+    (options, args) = parser.parse_args()
+
+    if len(args) in (1, 2):
+        folder = os.path.realpath(args[0])
+        destination = os.path.realpath(len(args) == 2 and os.path.realpath(args[1]) or folder)
+        cache = DiskCache(options.cache_dir) if options.cache_dir else None
+        # Outputs of :coffee, :sass and :scss go in the same cache
+        CompilerNode.disk_cache = cache
+        pool = _make_pool(options.jobs) if options.jobs > 1 else None
+
+        try:
+            if not options.poll and inotify.available():
+                print "Watching %s for changes" % folder
+                EventWatcher(folder, destination, cache, pool).run()
+            else:
+                print "Watching %s at refresh interval %s seconds" % (folder,CHECK_INTERVAL)
+                while True:
+                    _watch_folder(folder, destination, cache, pool=pool)
+                    time.sleep(CHECK_INTERVAL)
+        except KeyboardInterrupt:
+            # allow graceful exit (no stacktrace output)
+            if pool is not None:
+                pool.terminate()
+            sys.exit(0)
     else:
-        print "Usage: hamlpy-watcher.py <watch_folder> [destination_folder]"
+        print "Usage: hamlpy-watcher.py [--cache-dir DIR] [--poll] [--jobs N] <watch_folder> [destination_folder]"
+
+def _make_pool(processes):
+    # Workers ignore Ctrl-C, the main process terminates them
+    return multiprocessing.Pool(processes, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
 
-def _watch_folder(folder, destination):
+def _watch_folder(folder, destination, cache=None, subfolder=None, pool=None):
     """Compares "modified" timestamps against the "compiled" dict, calls compiler
-    if necessary."""
-    for dirpath, dirnames, filenames in os.walk(folder):
+    if necessary. Only looks inside `subfolder` of `folder` if one is given."""
+    jobs = []
+    for dirpath, filenames in _walk(subfolder or folder):
         for filename in filenames:
-            # Ignore filenames starting with ".#" for Emacs compatibility
-            if watched_extension(filename) and not filename.startswith('.#'):
-                fullpath = os.path.join(dirpath, filename)
-                subfolder = os.path.relpath(dirpath, folder)
-                mtime = os.stat(fullpath).st_mtime
-				
-                # Create subfolders in target directory if they don't exist
-                compiled_folder = os.path.join(destination, subfolder)
-                if not os.path.exists(compiled_folder):
-                    os.makedirs(compiled_folder)
-				
-                compiled_path = _compiled_path(compiled_folder, filename)
-                if (not fullpath in compiled or
-                    compiled[fullpath] < mtime or
-                    not os.path.isfile(compiled_path)):
-                    compile_file(fullpath, compiled_path)
-                    compiled[fullpath] = mtime
+            if _is_template(filename):
+                job = _job_if_changed(folder, destination, os.path.join(dirpath, filename))
+                if job:
+                    jobs.append(job)
+    _build(folder, destination, jobs, cache, pool)
+
+def _job_if_changed(folder, destination, fullpath, force=False):
+    """Returns a (fullpath, compiled path, mtime) job if the template needs to be compiled"""
+    try:
+        mtime = os.stat(fullpath).st_mtime
+    except OSError:
+        # Removed in the meantime
+        return None
+    dirpath, filename = os.path.split(fullpath)
+    compiled_folder = os.path.join(destination, os.path.relpath(dirpath, folder))
+    compiled_path = _compiled_path(compiled_folder, filename)
+    if (force or not fullpath in compiled or
+        compiled[fullpath] < mtime or
+        not _is_listed(compiled_path)):
+        # Create subfolders in target directory if they don't exist
+        if not os.path.isdir(compiled_folder):
+            os.makedirs(compiled_folder)
+        return fullpath, compiled_path, mtime
+    return None
+
+def _template_name(folder, fullpath):
+    return template_key(os.path.relpath(fullpath, folder))
+
+def _build(folder, destination, jobs, cache=None, pool=None):
+    """Compiles the jobs whose source or output changed since the manifest was written,
+    then the templates that extend or include those, directly or through other templates"""
+    manifest = _manifest(destination)
+    pending = []
+    for job in jobs:
+        fullpath, outfile_name, mtime = job
+        if manifest.is_current(fullpath, outfile_name):
+            compiled[fullpath] = mtime
+            _record_dependencies(folder, fullpath, manifest.dependencies(outfile_name))
+        else:
+            pending.append(job)
+
+    changed = set(_template_name(folder, fullpath) for fullpath, outfile_name, mtime in pending)
+    _compile_jobs(pending, cache, pool, manifest, folder)
+
+    affected = set()
+    for name in changed:
+        affected.update(dependency_graph.affected(name))
+    dependent_jobs = []
+    for name in sorted(affected - changed):
+        fullpath = template_paths.get(name)
+        job = fullpath and _job_if_changed(folder, destination, fullpath, force=True)
+        if job:
+            dependent_jobs.append(job)
+    _compile_jobs(dependent_jobs, cache, pool, manifest, folder)
+
+def _record_dependencies(folder, fullpath, dependencies):
+    name = _template_name(folder, fullpath)
+    template_paths[name] = fullpath
+    dependency_graph.update(name, dependencies)
+
+def _compile_jobs(jobs, cache=None, pool=None, manifest=None, folder=None):
+    """Compiles the jobs, in the process pool if there is one and several jobs.
+    What is printed about each file comes out in the order of the jobs either way."""
+    if pool is not None and len(jobs) > 1:
+        pending_results = pool.imap(_compile_job, [(fullpath, outfile_name, cache) for fullpath, outfile_name, mtime in jobs])
+        # Waiting with a timeout keeps the main process responsive to Ctrl-C
+        results = (pending_results.next(POOL_WAIT) for job in jobs)
+    else:
+        results = (_compile_file(fullpath, outfile_name, cache) for fullpath, outfile_name, mtime in jobs)
+    for (fullpath, outfile_name, mtime), (report, source_hash, output_hash, dependencies) in izip(jobs, results):
+        sys.stdout.write(report)
+        compiled[fullpath] = mtime
+        if folder is not None:
+            _record_dependencies(folder, fullpath, dependencies)
+        if manifest is not None:
+            manifest.record(outfile_name, source_hash, output_hash, dependencies)
+
+    if manifest is not None:
+        manifest.save()
+
+def _manifest(destination):
+    manifest = manifests.get(destination)
+    if manifest is None:
+        manifest = manifests[destination] = Manifest(destination)
+    return manifest
+
+class Manifest(object):
+    """Hashes of the source and output of every compiled template, kept in the destination
+    folder so that a restarted watcher only compiles templates whose content changed"""
+
+    FILENAME = '.hamlpy-manifest.json'
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.path = os.path.join(destination, self.FILENAME)
+        self.changed = False
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = json.load(f)['files']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = {}
+
+    def _key(self, outfile_name):
+        return os.path.relpath(outfile_name, self.destination)
+
+    def is_current(self, fullpath, outfile_name):
+        """True if `outfile_name` was compiled from the current content of `fullpath` by this version"""
+        entry = self.entries.get(self._key(outfile_name))
+        return (entry is not None and entry.get('version') == hamlpy.VERSION and
+                entry.get('source') == _file_hash(fullpath) and
+                entry.get('output') == _file_hash(outfile_name))
+
+    def dependencies(self, outfile_name):
+        """Templates the source of `outfile_name` extends or includes"""
+        entry = self.entries.get(self._key(outfile_name))
+        return entry.get('dependencies', []) if entry is not None else []
+
+    def record(self, outfile_name, source_hash, output_hash, dependencies=()):
+        key = self._key(outfile_name)
+        if output_hash is None:
+            # Failed to compile
+            self.entries.pop(key, None)
+        else:
+            self.entries[key] = {'source': source_hash, 'output': output_hash, 'version': hamlpy.VERSION,
+                                 'dependencies': list(dependencies)}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        if not os.path.isdir(self.destination):
+            os.makedirs(self.destination)
+        fd, tmp_path = tempfile.mkstemp(dir=self.destination, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump({'files': self.entries}, f, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+def _file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def _walk(folder):
+    """Like os.walk, but reuses the listing of directories that have not changed since the last call"""
+    stack = [folder]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            subdirectories, filenames = _list_directory(dirpath)
+        except OSError:
+            continue
+        yield dirpath, filenames
+        stack.extend(os.path.join(dirpath, name) for name in reversed(subdirectories))
+
+def _list_directory(path):
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_nlink, stat.st_size)
+    listing = listings.get(path)
+    if listing is None or listing[0] != key or listing[1] - stat.st_mtime <= LISTING_MTIME_SLACK:
+        listed_at = time.time()
+        subdirectories, filenames = [], []
+        if scandir is not None:
+            for entry in scandir(path):
+                if not entry.is_dir():
+                    filenames.append(entry.name)
+                elif not entry.is_symlink():
+                    subdirectories.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                entry_path = os.path.join(path, name)
+                if not os.path.isdir(entry_path):
+                    filenames.append(name)
+                elif not os.path.islink(entry_path):
+                    subdirectories.append(name)
+        listing = listings[path] = (key, listed_at, subdirectories, filenames)
+    return listing[2], listing[3]
+
+def _is_listed(path):
+    dirpath, filename = os.path.split(path)
+    try:
+        return filename in _list_directory(dirpath)[1]
+    except OSError:
+        return False
+
+class EventWatcher(object):
+    """Recompiles a template as soon as inotify reports that it was written"""
+
+    def __init__(self, folder, destination, cache=None, pool=None):
+        self.folder = folder
+        self.destination = destination
+        self.cache = cache
+        self.pool = pool
+        self.inotify = inotify.Inotify()
+        # watch descriptor -> watched directory
+        self.directories = {}
+        self._add_watches(folder)
+        # Catch up with everything that changed before the watches existed
+        _watch_folder(folder, destination, cache, pool=pool)
+
+    def run(self):
+        try:
+            while True:
+                self.process_events()
+        finally:
+            self.inotify.close()
+
+    def process_events(self, timeout=None):
+        """Waits up to `timeout` seconds for events and handles them"""
+        # Templates written at about the same time are compiled together
+        jobs = []
+        queued = set()
+        for wd, mask, cookie, name in self.inotify.read_events(timeout):
+            if mask & inotify.IN_Q_OVERFLOW:
+                # Events were lost, look at everything again
+                self._add_watches(self.folder)
+                _watch_folder(self.folder, self.destination, self.cache, pool=self.pool)
+                continue
+
+            dirpath = self.directories.get(wd)
+            if dirpath is None:
+                continue
+            if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                del self.directories[wd]
+                continue
+
+            if isinstance(dirpath, unicode):
+                name = name.decode(sys.getfilesystemencoding())
+            path = os.path.join(dirpath, name)
+            if mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    self._add_watches(path)
+                    _watch_folder(self.folder, self.destination, self.cache, subfolder=path, pool=self.pool)
+            elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO) and _is_template(name):
+                job = _job_if_changed(self.folder, self.destination, path, force=True)
+                if job and path not in queued:
+                    jobs.append(job)
+                    queued.add(path)
+        _build(self.folder, self.destination, jobs, self.cache, self.pool)
+
+    def _add_watches(self, folder):
+        for dirpath, filenames in _walk(folder):
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+            except OSError:
+                continue
+            self.directories[wd] = dirpath
+
+    def close(self):
+        self.inotify.close()
 
 def _compiled_path(destination, filename):
     return os.path.join(destination, filename[:filename.rfind('.')] + '.html')
 
-def compile_file(fullpath, outfile_name):
-    """Calls HamlPy compiler."""
-    print '%s %s -> %s' % ( strftime("%H:%M:%S", gmtime()), fullpath, outfile_name )
+def compile_file(fullpath, outfile_name, cache=None):
+    """Calls HamlPy compiler, reusing the output stored in `cache` (a DiskCache) if there is one."""
+    sys.stdout.write(_compile_file(fullpath, outfile_name, cache)[0])
+
+def _compile_job(args):
+    return _compile_file(*args)
+
+def _compile_file(fullpath, outfile_name, cache=None):
+    """Compiles a file and returns what compile_file prints about it, the hashes of the
+    source and the output (None if compiling failed) and the templates it extends or includes"""
+    report = ['%s %s -> %s\n' % ( strftime("%H:%M:%S", gmtime()), fullpath, outfile_name )]
+    source_hash = output_hash = None
+    dependencies = []
     try:
         if DEBUG:
-            print "Compiling %s -> %s" % (fullpath, outfile_name)
-        haml_lines = codecs.open(fullpath, 'r', encoding='utf-8').read().splitlines()
-        compiler = hamlpy.Compiler()
-        output = compiler.process_lines(haml_lines)
-        outfile = codecs.open(outfile_name, 'w', encoding='utf-8')
-        outfile.write(output)
+            report.append("Compiling %s -> %s\n" % (fullpath, outfile_name))
+        with open(fullpath, 'rb') as infile:
+            source = infile.read()
+        haml_lines = source.decode('utf-8').splitlines()
+        compiler = hamlpy.Compiler(cache=cache)
+        output = compiler.process_lines(haml_lines).encode('utf-8')
+        with open(outfile_name, 'wb') as outfile:
+            outfile.write(output)
+        source_hash = hashlib.sha1(source).hexdigest()
+        if not compiler.failed:
+            # Otherwise compiled again after a restart, once the filter may work
+            output_hash = hashlib.sha1(output).hexdigest()
+        dependencies = compiler.dependencies
     except Exception, e:
-        # import traceback
-        print "Failed to compile %s -> %s\nReason:\n%s" % (fullpath, outfile_name, e)
-        # print traceback.print_exc()
+        report.append("Failed to compile %s -> %s\nReason:\n%s\n" % (fullpath, outfile_name, e))
+    return ''.join(report), source_hash, output_hash, dependencies
 
 if __name__ == '__main__':
     watch_folder()
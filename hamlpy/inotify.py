@@ -0,0 +1,105 @@
+'''Minimal ctypes binding to the Linux inotify API, used by hamlpy-watcher'''
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event without the trailing name
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+def available():
+    return _libc is not None
+
+
+def _raise_errno(filename=None):
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code), filename)
+
+
+class Inotify(object):
+    '''An inotify instance, events are read with `read_events`'''
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available on this system')
+        self.fd = _libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            _raise_errno()
+
+    def add_watch(self, path, mask):
+        '''Watches `path` for the events in `mask` and returns the watch descriptor'''
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = _libc.inotify_add_watch(self.fd, ctypes.c_char_p(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            _raise_errno(path)
+        return wd
+
+    def remove_watch(self, wd):
+        # Fails if the kernel already dropped the watch, which is fine
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        '''Waits up to `timeout` seconds (forever if None) and returns the pending events
+        as a list of (watch descriptor, mask, cookie, name) tuples'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
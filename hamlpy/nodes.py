@@ -1,19 +1,20 @@
 import re
-import sys
+import ast
+import __builtin__
 from StringIO import StringIO
 
 from elements import Element
 
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import guess_lexer
-
-from markdown import markdown
-
-import subprocess
+import hashlib
 import json
+import threading
+from contextlib import contextmanager
+
+from cache import LRUCache
+from compilers import SubprocessBackend
 
-import typo
+# pygments, markdown and typo are imported by the nodes that use them, so templates
+# without those filters neither load them nor need them installed
 
 
 ELEMENT = '%'
@@ -30,6 +31,8 @@ TAG = '-'
 
 INLINE_VARIABLE = re.compile(r'(?<!\\)([#=]\{\s*(.+?)\s*\})')
 ESCAPED_INLINE_VARIABLE = re.compile(r'\\([#=]\{\s*(.+?)\s*\})')
+# ~[en] text uses the typography ruleset of the given locale
+TYPO_LOCALE = re.compile(r'~\[([\w-]+)\] ')
 
 COFFEESCRIPT_FILTERS = [':coffeescript', ':coffee']
 BARE_COFFEESCRIPT_FILTERS = [':coffeescript-bare', ':coffee-bare']
@@ -48,102 +51,182 @@ ELEMENT_CHARACTERS = (ELEMENT, ID, CLASS)
 
 HAML_ESCAPE = '\\'
 
-def create_node(haml_line):
-    stripped_line = haml_line.strip()
+# Registered filters, name (without the colon) -> FilterNode subclass, 'module:ClassName'
+# string or setuptools entry point. Strings and entry points are imported on first use.
+FILTERS = {}
+
+FILTER_ENTRY_POINT_GROUP = 'hamlpy.filters'
+_entry_points_loaded = False
+# "project version" of the distribution each entry point filter comes from
+_filter_distributions = {}
+
+def register_filter(name, node_class):
+    """Makes `:name` in templates create a `node_class` node.
+
+    `node_class` is a FilterNode subclass or a 'package.module:ClassName' string that is
+    only imported once a template uses the filter.
+    """
+    if name.startswith(':'):
+        name = name[1:]
+    FILTERS[name] = node_class
+
+def get_filter(name):
+    """Returns the FilterNode subclass registered for `name` (without the colon), or None"""
+    if name not in FILTERS:
+        _load_entry_points()
+    node_class = FILTERS.get(name)
+    if node_class is None or isinstance(node_class, type):
+        return node_class
+
+    if isinstance(node_class, basestring):
+        module_name, _, class_name = node_class.partition(':')
+        module = __import__(module_name, fromlist=[class_name])
+        node_class = getattr(module, class_name)
+    else:
+        node_class = node_class.load()
+    FILTERS[name] = node_class
+    return node_class
+
+def _load_entry_points():
+    """Registers the filters other distributions advertise, without importing them"""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(FILTER_ENTRY_POINT_GROUP):
+        # Filters registered explicitly take precedence
+        if FILTERS.setdefault(entry_point.name, entry_point) is entry_point and entry_point.dist is not None:
+            _filter_distributions[entry_point.name] = '%s %s' % (entry_point.dist.project_name, entry_point.dist.version)
+
+def filters_fingerprint():
+    """Describes the registered filters, and the versions of the distributions of the plugin ones,
+    the same way whether or not they have been imported yet"""
+    _load_entry_points()
+    filters = []
+    for name, node_class in sorted(FILTERS.items()):
+        if name in _filter_distributions:
+            filters.append((name, _filter_distributions[name]))
+        elif isinstance(node_class, type):
+            filters.append((name, '%s:%s' % (node_class.__module__, node_class.__name__)))
+        else:
+            filters.append((name, str(node_class)))
+    return repr(filters)
 
-    if len(stripped_line)==0:
-        return None
-    
-    if re.match(INLINE_VARIABLE, stripped_line) or re.match(ESCAPED_INLINE_VARIABLE, stripped_line):
-        return PlaintextNode(haml_line)
-    
-    if stripped_line[0] == HAML_ESCAPE:
-        return PlaintextNode(haml_line)
-        
+def _create_inline_variable_or(node_class):
+    def create(haml_line, stripped_line):
+        if INLINE_VARIABLE.match(stripped_line):
+            return PlaintextNode(haml_line)
+        return node_class(haml_line)
+    return create
+
+def _create_doctype(haml_line, stripped_line):
     if stripped_line.startswith(DOCTYPE):
         return DoctypeNode(haml_line)
+    return PlaintextNode(haml_line)
 
-    if stripped_line[0] in ELEMENT_CHARACTERS:
-        return ElementNode(haml_line)
-    
-    if stripped_line[0:len(CONDITIONAL_COMMENT)] == CONDITIONAL_COMMENT:
+def _create_comment(haml_line, stripped_line):
+    if stripped_line.startswith(CONDITIONAL_COMMENT):
         return ConditionalCommentNode(haml_line)
-        
-    if stripped_line[0] == HTML_COMMENT:
-        return CommentNode(haml_line)
-    
-    for comment_prefix in HAML_COMMENTS:
-        if stripped_line.startswith(comment_prefix):
-            return HamlCommentNode(haml_line)
-    
-    if stripped_line[0] == VARIABLE:
-        return VariableNode(haml_line)
-
-    if stripped_line[0] == TAG:
-        return TagNode(haml_line)
-    
-    if stripped_line == JAVASCRIPT_FILTER:
-        return JavascriptFilterNode(haml_line)
-    
-    if stripped_line in COFFEESCRIPT_FILTERS:
-        return CoffeeScriptFilterNode(haml_line)
-
-    if stripped_line in BARE_COFFEESCRIPT_FILTERS:
-        return BareCoffeeScriptFilterNode(haml_line)
+    return CommentNode(haml_line)
 
-    if stripped_line == SASS_FILTER:
-        return SassFilterNode(haml_line)
+def _create_tag(haml_line, stripped_line):
+    if stripped_line.startswith('-#'):
+        return HamlCommentNode(haml_line)
+    return TagNode(haml_line)
 
-    if stripped_line == SCSS_FILTER:
-        return ScssFilterNode(haml_line)
+def _create_variable(haml_line, stripped_line):
+    if INLINE_VARIABLE.match(stripped_line):
+        return PlaintextNode(haml_line)
+    if stripped_line.startswith('=#'):
+        return HamlCommentNode(haml_line)
+    return VariableNode(haml_line)
+
+def _create_filter(haml_line, stripped_line):
+    name = stripped_line[1:]
+    node_class = get_filter(name)
+    if node_class is None and len(name.split(None, 1)) == 2:
+        # Filters that take arguments, e.g. ":highlight python"
+        node_class = get_filter(name.split(None, 1)[0])
+        if not getattr(node_class, 'takes_arguments', False):
+            node_class = None
+    if node_class is None:
+        return PlaintextNode(haml_line)
+    return node_class(haml_line)
+
+def _match_typo_locale(line):
+    """Matches a ~[locale] prefix, only if there is a typography ruleset for that locale"""
+    match = TYPO_LOCALE.match(line)
+    if match:
+        import typo
+        if match.group(1) in typo.rulesets:
+            return match
+    return None
+
+def _create_typo(haml_line, stripped_line):
+    if stripped_line.startswith("~ ") or _match_typo_locale(stripped_line):
+        return TypoNode(haml_line)
+    return PlaintextNode(haml_line)
 
-    if stripped_line == CSS_FILTER:
-        return CssFilterNode(haml_line)
-    
-    if stripped_line == STYLUS_FILTER:
-        return StylusFilterNode(haml_line)
+def create_node(haml_line):
+    stripped_line = haml_line.strip()
 
-    if stripped_line == PLAIN_FILTER:
-        return PlainFilterNode(haml_line)
-        
-    if stripped_line == PYTHON_FILTER:
-        return PythonFilterNode(haml_line)
-    
-    if stripped_line == CDATA_FILTER:
-        return CDataFilterNode(haml_line)
-		
-    if stripped_line == PYGMENTS_FILTER:
-        return PygmentsFilterNode(haml_line)
+    if len(stripped_line)==0:
+        return None
 
-    if stripped_line == MARKDOWN_FILTER:
-        return MarkdownFilterNode(haml_line)
+    factory = NODE_FACTORIES.get(stripped_line[0])
+    if factory is None:
+        return PlaintextNode(haml_line)
+    return factory(haml_line, stripped_line)
 
-    if stripped_line.startswith("~ "):
-        return TypoNode(haml_line)
+def _walk(nodes, method, descend):
+    '''Calls `method` on `nodes` and their descendants in document order, without recursion.
 
-    return PlaintextNode(haml_line)
+    The children of a node are skipped when its `descend` attribute is false.
+    '''
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        getattr(node, method)()
+        if node.children and getattr(node, descend):
+            stack.extend(reversed(node.children))
 
 class TreeNode(object):
     ''' Generic parent/child tree class'''
+    # Templates can have tens of thousands of nodes, so none of them carries an instance dict
+    __slots__ = ('parent', 'children', 'previous_sibling', 'next_sibling')
+
     def __init__(self):
         self.parent=None
         self.children=[]
+        # Neighbours in the parent's children, kept up to date by add_child
+        self.previous_sibling=None
+        self.next_sibling=None
 
     def left_sibling(self):
-        siblings=self.parent.children
-        index=siblings.index(self)
-        return siblings[index-1] if index>0 else None
+        return self.previous_sibling
 
     def right_sibling(self):
-        siblings=self.parent.children
-        index=siblings.index(self)
-        return siblings[index+1] if index<len(siblings)-1 else None
+        return self.next_sibling
 
     def add_child(self,child):
         child.parent=self
+        if self.children:
+            last=self.children[-1]
+            last.next_sibling=child
+            child.previous_sibling=last
         self.children.append(child)
 
 class RootNode(TreeNode):
+    __slots__ = ('indentation', 'newlines', 'before', 'after', 'empty_node')
+
+    # Whether the render and post-render passes visit the children of the node
+    renders_children = True
+    post_renders_children = True
+
     def __init__(self):
         TreeNode.__init__(self)
         self.indentation = -2
@@ -157,10 +240,11 @@ class RootNode(TreeNode):
         self.empty_node=False
 
     def render(self):
-        # Render (sets self.before and self.after)
-        self._render_children()
+        # Render (sets self.before and self.after), running the external filters together at the end
+        with compiler_batch():
+            self._render_children()
         # Post-render (nodes can modify the rendered text of other nodes)
-        self._post_render()
+        self._post_render_children()
         # Generate HTML
         return self._generate_html()
 
@@ -175,27 +259,38 @@ class RootNode(TreeNode):
             return self
 
     def inside_filter_node(self):
-        if self.parent:
-            return self.parent.inside_filter_node()
-        else:
-            return False
+        node = self.parent
+        while node:
+            if isinstance(node, FilterNode):
+                return True
+            node = node.parent
+        return False
 
     def _render_children(self):
-        for child in self.children:
-            child._render()
-            
+        _walk(self.children, '_render_node', 'renders_children')
+
+    def _render_node(self):
+        self._render()
+
+    def _post_render_children(self):
+        _walk(self.children, '_post_render', 'post_renders_children')
+
     def _post_render(self):
-        for child in self.children:
-            child._post_render()
+        pass
 
     def _generate_html(self):
+        # Rendered text of the node and its descendants in document order. Each node is
+        # replaced on the stack by its `before`, children and `after`
         output=[]
-        output.append(self.before)
-        for child in self.children:
-            output.append(child.before)
-            output += [gc._generate_html() for gc in child.children]
-            output.append(child.after)
-        output.append(self.after)
+        stack=[self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, RootNode):
+                output.append(item.before)
+                stack.append(item.after)
+                stack.extend(reversed(item.children))
+            else:
+                output.append(item)
         return ''.join(output)
     
     def add_node(self, node):
@@ -212,26 +307,90 @@ class RootNode(TreeNode):
         return False
 
     def debug_tree(self):
-        return '\n'.join(self._debug_tree([self]))
-
-    def _debug_tree(self, nodes):
         output=[]
-        for n in nodes:
+        stack=[self]
+        while stack:
+            n = stack.pop()
             output.append('%s%s' % (' '*(n.indentation+2), n))
-            if n.children:
-                output += self._debug_tree(n.children)
-        return output
+            stack.extend(reversed(n.children))
+        return '\n'.join(output)
 
     def __repr__(self):
         return '(%s)' % (self.__class__)
 
-class HamlNode(RootNode):   
+class StreamRootNode(RootNode):
+    '''Root node that renders each top-level node as soon as it is closed and passes its
+    HTML to `write`, so that only a few top-level subtrees are held in memory.
+
+    A top-level node is closed once the next one is added. Post-rendering a node can change
+    the text of its siblings, so it waits until its right sibling has been rendered, and the
+    node is written out once its right sibling has been post-rendered as well.
+    '''
+    __slots__ = ('write', 'rendered', 'post_rendered')
+
+    def __init__(self, write):
+        RootNode.__init__(self)
+        self.write = write
+        # Number of leading children that have been rendered / post-rendered
+        self.rendered = 0
+        self.post_rendered = 0
+
+    def add_child(self, child):
+        RootNode.add_child(self, child)
+        self._flush(len(self.children) - 1)
+
+    def finish(self):
+        '''Renders and writes the remaining nodes once there is no more input'''
+        self._flush(len(self.children), final=True)
+
+    def _flush(self, closed, final=False):
+        children = self.children
+        with compiler_batch():
+            for child in children[self.rendered:closed]:
+                _walk([child], '_render_node', 'renders_children')
+        self.rendered = closed
+
+        ready = closed if final else closed - 1
+        for child in children[self.post_rendered:ready]:
+            _walk([child], '_post_render', 'post_renders_children')
+        self.post_rendered = max(self.post_rendered, ready)
+
+        done = self.post_rendered if final else self.post_rendered - 1
+        if done > 0:
+            # The root itself renders nothing, only its children need to be written
+            for child in children[:done]:
+                self.write(child._generate_html())
+            del children[:done]
+            if children:
+                # Written nodes are no longer siblings of the remaining ones
+                children[0].previous_sibling = None
+            self.rendered -= done
+            self.post_rendered -= done
+
+# Indentation strings shared by all nodes, keyed on (indentation character, width)
+_indentation_strings = {}
+
+def _indentation_string(character, indentation):
+    key = (character, indentation)
+    spaces = _indentation_strings.get(key)
+    if spaces is None:
+        spaces = _indentation_strings[key] = character * indentation
+    return spaces
+
+class HamlNode(RootNode):
+    __slots__ = ('haml', 'raw_haml', 'spaces')
+
     def __init__(self, haml):
         RootNode.__init__(self)
         self.haml = haml.strip()
         self.raw_haml = haml
         self.indentation = (len(haml) - len(haml.lstrip()))
-        self.spaces = ''.join(haml[0] for i in range(self.indentation))
+        self.spaces = _indentation_string(haml[:1], self.indentation)
+
+    def _render_node(self):
+        self._render()
+        # The source line is only needed by filters, which render their children themselves
+        self.raw_haml = None
 
     def replace_inline_variables(self, content):
         content = re.sub(INLINE_VARIABLE, r'{{ \2 }}', content)
@@ -243,6 +402,8 @@ class HamlNode(RootNode):
 
 class PlaintextNode(HamlNode):
     '''Node that is not modified or processed when rendering'''
+    __slots__ = ()
+
     def _render(self):
         text = self.replace_inline_variables(self.haml)
         # Remove escape character unless inside filter node
@@ -254,20 +415,25 @@ class PlaintextNode(HamlNode):
             self.before += self.render_newlines()
         else:
             self.after = self.render_newlines()
-        self._render_children()
 
 class ElementNode(HamlNode):
     '''Node which represents a HTML tag'''
+    __slots__ = ('django_variable', 'nuke_inner_whitespace', 'nuke_outer_whitespace')
+
     def __init__(self, haml):
         HamlNode.__init__(self,haml)
         self.django_variable = False
+        self.nuke_inner_whitespace = False
+        self.nuke_outer_whitespace = False
 
     def _render(self):
-        self.element = Element(self.haml)
-        self.django_variable = self.element.django_variable
-        self.before = self._render_before(self.element)
-        self.after = self._render_after(self.element)
-        self._render_children()
+        # Only the whitespace removal flags are needed after rendering, not the whole Element
+        element = Element(self.haml)
+        self.django_variable = element.django_variable
+        self.nuke_inner_whitespace = element.nuke_inner_whitespace
+        self.nuke_outer_whitespace = element.nuke_outer_whitespace
+        self.before = self._render_before(element)
+        self.after = self._render_after(element)
 
     def _render_before(self, element):
         '''Render opening tag and inline content'''
@@ -279,7 +445,7 @@ class ElementNode(HamlNode):
         if element.attributes:
             start.append(' ' + self.replace_inline_variables(element.attributes))
 
-        content = self._render_inline_content(self.element.inline_content)
+        content = self._render_inline_content(element.inline_content)
 
         if element.nuke_inner_whitespace and content:
             content = content.strip()
@@ -307,7 +473,7 @@ class ElementNode(HamlNode):
 
     def _post_render(self):
         # Inner whitespace removal
-        if self.element.nuke_inner_whitespace:
+        if self.nuke_inner_whitespace:
             self.before = self.before.rstrip()
             self.after = self.after.lstrip()
 
@@ -326,7 +492,7 @@ class ElementNode(HamlNode):
                     node.children[-1].after=node.children[-1].after.rstrip()
 
         # Outer whitespace removal
-        if self.element.nuke_outer_whitespace:
+        if self.nuke_outer_whitespace:
             left_sibling = self.left_sibling()
             if left_sibling:
                 # If node has left sibling, strip whitespace after left sibling
@@ -348,7 +514,6 @@ class ElementNode(HamlNode):
                 self.parent.after = self.parent.after.lstrip()
                 self.parent.newlines = 0
 
-        super(ElementNode, self)._post_render()    
 
     def _render_inline_content(self, inline_content):
         if inline_content == None or len(inline_content)==0:
@@ -361,15 +526,18 @@ class ElementNode(HamlNode):
             return self.replace_inline_variables(inline_content)
         
 class CommentNode(HamlNode):    
+    __slots__ = ()
+
     def _render(self):
         self.after =  "-->\n"
         if self.children:
             self.before ="<!-- %s" % (self.render_newlines())
-            self._render_children()
         else:
             self.before = "<!-- %s " % (self.haml.lstrip(HTML_COMMENT).strip())
 
 class ConditionalCommentNode(HamlNode):
+    __slots__ = ()
+
     def _render(self):
         conditional = self.haml[1: self.haml.index(']')+1 ]
 
@@ -380,9 +548,12 @@ class ConditionalCommentNode(HamlNode):
             self.before = "<!--%s>%s" % (conditional, content)
             
         self.after = "<![endif]-->"
-        self._render_children()
 
 class DoctypeNode(HamlNode):
+    __slots__ = ()
+
+    renders_children = False
+
     def _render(self):
         doctype = self.haml.lstrip(DOCTYPE).strip()
 
@@ -405,13 +576,20 @@ class DoctypeNode(HamlNode):
         self.after = self.render_newlines()
 
 class HamlCommentNode(HamlNode):
+    __slots__ = ()
+
+    renders_children = False
+    post_renders_children = False
+
     def _render(self):
         self.after = self.render_newlines()[1:]
 
-    def _post_render(self):
-        pass
-
 class VariableNode(ElementNode):
+    __slots__ = ()
+
+    renders_children = False
+    post_renders_children = False
+
     def __init__(self, haml):
         ElementNode.__init__(self, haml)
         self.django_variable = True
@@ -430,6 +608,8 @@ class VariableNode(ElementNode):
         pass
 
 class TagNode(HamlNode):
+    __slots__ = ('tag_statement', 'tag_name')
+
     self_closing = {'for':'endfor',
                     'if':'endif',
                     'ifchanged':'endifchanged',
@@ -470,19 +650,32 @@ class TagNode(HamlNode):
                 self.before += self.render_newlines()
             else:
                 self.after = self.render_newlines()
-        self._render_children()
     
     def should_contain(self, node):
         return isinstance(node,TagNode) and node.tag_name in self.may_contain.get(self.tag_name,'')
 
 
 class FilterNode(HamlNode):
+    __slots__ = ()
+
+    # Whether the filter line can have arguments after the name, available as self.arguments()
+    takes_arguments = False
+
+    # Children are rendered as plain text by the filter itself and must not be
+    # interpreted as HAML, so neither pass visits them
+    renders_children = False
+    post_renders_children = False
+
     def add_node(self, node):
         self.add_child(node)
 
     def inside_filter_node(self):
         return True
 
+    def arguments(self):
+        """Words after the filter name"""
+        return self.haml.split()[1:]
+
     def _render_children_as_plain_text(self,remove_indentation=True):
         if self.children:
             initial_indentation = len(self.children[0].spaces)
@@ -495,12 +688,10 @@ class FilterNode(HamlNode):
             child.before += child.haml
             child.after = child.render_newlines()
 
-    def _post_render(self):
-        # Don't post-render children of filter nodes as we don't want them to be interpreted as HAML
-        pass
-      
 
 class PlainFilterNode(FilterNode):
+    __slots__ = ()
+
     def __init__(self, haml):
         FilterNode.__init__(self, haml)
         self.empty_node=True
@@ -510,34 +701,83 @@ class PlainFilterNode(FilterNode):
             first_indentation = self.children[0].indentation
         self._render_children_as_plain_text()
 
+# Name of the file like object the output of a :python block is printed to
+PYTHON_OUTPUT = '__hamlpy_output__'
+
+class _PrintToOutput(ast.NodeTransformer):
+    """Turns `print x` into `print >>__hamlpy_output__, x`, so that a :python block
+    prints to its own buffer instead of sys.stdout, which other threads share"""
+
+    def visit_Print(self, node):
+        if node.dest is None:
+            node.dest = ast.copy_location(ast.Name(id=PYTHON_OUTPUT, ctx=ast.Load()), node)
+        return node
+
+def _print_function(output):
+    # print() for blocks that import print_function
+    builtin_print = getattr(__builtin__, 'print')
+    def print_(*args, **kwargs):
+        kwargs.setdefault('file', output)
+        builtin_print(*args, **kwargs)
+    return print_
+
 class PythonFilterNode(FilterNode):
+    """:python [deterministic] runs the block and outputs what it prints. The output of a
+    block marked deterministic is cached, so it must not depend on anything but its code."""
+    __slots__ = ()
+
+    takes_arguments = True
+
+    # Code objects keyed on the source hash, shared by all compilers
+    code_cache = LRUCache(maxsize=256)
+
+    # Output of deterministic blocks keyed on the source hash
+    output_cache = LRUCache(maxsize=256)
+
     def _render(self):
         if self.children:
             self.before = self.render_newlines()[1:]
             indent_offset = len(self.children[0].spaces)
             code = "\n".join([node.raw_haml[indent_offset:] for node in self.children]) + '\n'
-            compiled_code = compile(code, "", "exec")
-
-            buffer = StringIO()
-            sys.stdout = buffer
-            try:
-                exec compiled_code
-            except Exception as e:
-                # Change exception message to let developer know that exception comes from
-                # a PythonFilterNode
-                if e.args:
-                    args = list(e.args)
-                    args[0] = "Error in :python filter code: " + e.message
-                    e.args = tuple(args)
-                raise e
-            finally:
-                # restore the original stdout
-                sys.stdout = sys.__stdout__
-            self.before += buffer.getvalue()
+            self.before += self._run(code)
         else:
             self.after = self.render_newlines()
 
+    def _run(self, code):
+        source = code.encode('utf-8') if isinstance(code, unicode) else code
+        key = hashlib.sha1(source).hexdigest()
+        deterministic = 'deterministic' in self.arguments()
+        if deterministic:
+            output = self.output_cache.get(key)
+            if output is not None:
+                return output
+
+        compiled_code = self.code_cache.get(key)
+        if compiled_code is None:
+            tree = _PrintToOutput().visit(ast.parse(code, "", "exec"))
+            compiled_code = compile(tree, "", "exec")
+            self.code_cache.set(key, compiled_code)
+
+        buffer = StringIO()
+        namespace = {PYTHON_OUTPUT: buffer, 'print': _print_function(buffer)}
+        try:
+            exec compiled_code in namespace
+        except Exception as e:
+            # Change exception message to let developer know that exception comes from
+            # a PythonFilterNode
+            if e.args:
+                args = list(e.args)
+                args[0] = "Error in :python filter code: " + e.message
+                e.args = tuple(args)
+            raise e
+        output = buffer.getvalue()
+        if deterministic:
+            self.output_cache.set(key, output)
+        return output
+
 class JavascriptFilterNode(FilterNode):
+    __slots__ = ()
+
     def _render(self):
         self.before = '<script type=\'text/javascript\'>\n// <![CDATA[%s' % (self.render_newlines())
         self.after = '// ]]>\n</script>\n'
@@ -545,98 +785,361 @@ class JavascriptFilterNode(FilterNode):
 
 
 class TypoNode(HamlNode):
+    __slots__ = ()
+
+    renders_children = False
 
     def _render(self):
-        texts = [self.haml[1:]]
+        import typo
+        match = _match_typo_locale(self.haml)
+        if match:
+            locale, texts = match.group(1), [self.haml[match.end():]]
+        else:
+            locale, texts = None, [self.haml[1:]]
         for child in self.children:
             if not isinstance(child, PlaintextNode):
                 raise RuntimeError("can only nest plain text into typo")
             texts.append(child.haml)
         text = " ".join(texts)
-        self.before = "%s%s" % (self.spaces, typo.typo(text))
+        self.before = "%s%s" % (self.spaces, typo.typo_many([text], locale)[0])
         self.after = self.render_newlines()
 
 
 
+# External filter blocks waiting for the end of the render pass on this thread
+_batch = threading.local()
+
+@contextmanager
+def compiler_batch():
+    """Defers the external compilers of the CompilerNodes rendered inside the block
+    and runs them together, in one backend call, when it ends"""
+    if getattr(_batch, 'jobs', None) is not None:
+        # Already inside a batch
+        yield
+        return
+    jobs = _batch.jobs = []
+    try:
+        yield
+    finally:
+        _batch.jobs = None
+    if jobs:
+        results = CompilerNode._compile_many([(args, data) for node, args, data in jobs])
+        for (node, args, data), (output, err) in zip(jobs, results):
+            node._finish(output, err)
+
+@contextmanager
+def filter_settings(**settings):
+    """Makes the filters rendered on this thread inside the block use the given `backend`,
+    `disk_cache` or `markdown_extensions` instead of the class attributes CompilerNode.backend,
+    CompilerNode.disk_cache and MarkdownFilterNode.extensions. None keeps the class attribute."""
+    previous = dict((name, getattr(_batch, name, None)) for name in settings)
+    for name, value in settings.items():
+        setattr(_batch, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(_batch, name, value)
+
+def filter_setting(name, default):
+    """The value of `name` set by filter_settings on this thread, `default` if there is none"""
+    value = getattr(_batch, name, None)
+    return default if value is None else value
+
+def compiler_backend(backend):
+    """Makes the CompilerNodes rendered on this thread inside the block use `backend`"""
+    return filter_settings(backend=backend)
+
+@contextmanager
+def filter_errors():
+    """Collects the errors of the external compilers run on this thread inside the block
+    into the list it yields, so output rendered with an error message is not cached"""
+    outer = getattr(_batch, 'errors', None)
+    errors = _batch.errors = []
+    try:
+        yield errors
+    finally:
+        _batch.errors = outer
+        if outer is not None:
+            outer.extend(errors)
+
+
 class CompilerNode(FilterNode):
+    __slots__ = ()
+
+    # Successful outputs of the external compilers keyed on (command line, source hash), shared by all compilers
+    output_cache = LRUCache(maxsize=256)
+
+    # Optional hamlpy.cache.DiskCache that keeps the outputs across processes and restarts
+    disk_cache = None
+
+    # Runs the compilers, see hamlpy.compilers
+    backend = SubprocessBackend()
+
+    def _compile_later(self, args, data):
+        """Calls self._finish(output, error) once the block has been compiled,
+        at the end of the render pass if there is a batch"""
+        jobs = getattr(_batch, 'jobs', None)
+        if jobs is None:
+            self._finish(*self._compile(args, data))
+        else:
+            jobs.append((self, args, data))
+
+    # The compiled block is rendered between `opening` and `closing`. If the compiler fails,
+    # `error_format` % the error as a JSON string is rendered instead, to show it in the page.
+    opening = ''
+    closing = ''
+    error_format = '%s'
+
+    def _finish(self, output, err):
+        if err:
+            output = self.error_format % json.dumps(err)
+        self.before = '%s%s%s' % (self.opening, self.render_newlines(), output)
+        self.after = self.closing
 
     def _compile(self, args, data):
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                      stdin=subprocess.PIPE)
-        return proc.communicate(data)
+        return self._compile_many([(args, data)])[0]
+
+    @classmethod
+    def _compile_many(cls, blocks):
+        results = [None] * len(blocks)
+        misses = []
+        disk_cache = filter_setting('disk_cache', cls.disk_cache)
+        for i, (args, data) in enumerate(blocks):
+            source = data.encode('utf-8') if isinstance(data, unicode) else data
+            key = (tuple(args), hashlib.sha1(source).hexdigest())
+            output = cls.output_cache.get(key)
+            if output is None and disk_cache is not None:
+                output = disk_cache.get(disk_cache.make_key('filter', key[1], *args))
+                if output is not None:
+                    output = output.encode('utf-8')
+                    cls.output_cache.set(key, output)
+            if output is not None:
+                results[i] = (output, '')
+            else:
+                misses.append((i, key, data))
+
+        if misses:
+            backend = filter_setting('backend', cls.backend)
+            compiled = backend.compile([(list(key[0]), data) for i, key, data in misses])
+            errors = getattr(_batch, 'errors', None)
+            for (i, key, data), (output, err) in zip(misses, compiled):
+                results[i] = (output, err)
+                # Errors are not cached, they may come from the environment rather than the source
+                if not err:
+                    cls._store(key, output, disk_cache)
+                elif errors is not None:
+                    errors.append(err)
+        return results
+
+    @classmethod
+    def _store(cls, key, output, disk_cache):
+        cls.output_cache.set(key, output)
+        if disk_cache is not None:
+            try:
+                disk_cache.set(disk_cache.make_key('filter', key[1], *key[0]), output.decode('utf-8'))
+            except UnicodeDecodeError:
+                pass
 
 
 class CoffeeScriptFilterNode(CompilerNode):
+    __slots__ = ()
 
     args = ["coffee", "-sc"]
 
+    opening = '<script type=\'text/javascript\'>\n// <![CDATA['
+    closing = '// ]]>\n</script>\n'
+    error_format = 'alert(%s)'
+
     def _render(self):
         indent_offset = len(self.children[0].spaces)
         code = "\n".join([node.raw_haml[indent_offset:] for node in self.children]) + '\n'
-        js, err = self._compile(self.args, code)
-        if err:
-            js = "alert(%s)" % json.dumps(str(err))
-        self.before = '<script type=\'text/javascript\'>\n// <![CDATA[%s%s' % (self.render_newlines(), js)
-        self.after = '// ]]>\n</script>\n'
+        self._compile_later(self.args, code)
 
 
 class BareCoffeeScriptFilterNode(CoffeeScriptFilterNode):
+    __slots__ = ()
 
     args = ["coffee", "-scb"]
 
 
 class SassFilterNode(CompilerNode):
+    __slots__ = ()
 
     cmd = "sass"
 
+    opening = '<style type=\'text/css\'>\n/*<![CDATA[*/'
+    closing = '/*]]>*/\n</style>\n'
+    error_format = 'body:before{content:%s}'
+
     def _render(self):
         indent_offset = len(self.children[0].spaces)
         code = "\n".join([node.raw_haml[indent_offset:] for node in self.children]) + '\n'
-        css, err = self._compile([self.cmd, "-s", "--compass"], code)
-        if err:
-            css = "body:before{content:%s}" % json.dumps(err)
-        self.before = '<style type=\'text/css\'>\n/*<![CDATA[*/%s%s' % (self.render_newlines(), css)
-        self.after = '/*]]>*/\n</style>\n'
+        self._compile_later([self.cmd, "-s", "--compass"], code)
 
 
 class ScssFilterNode(SassFilterNode):
+    __slots__ = ()
+
     cmd = "scss"
 
 
 class CssFilterNode(FilterNode):
+    __slots__ = ()
+
     def _render(self):
         self.before = '<style type=\'text/css\'>\n/*<![CDATA[*/%s' % (self.render_newlines())
         self.after = '/*]]>*/\n</style>\n'
         self._render_children_as_plain_text(remove_indentation=False)
 
 class StylusFilterNode(FilterNode):
+    __slots__ = ()
+
     def _render(self):
         self.before = '<style type=\'text/stylus\'>\n/*<![CDATA[*/%s' % (self.render_newlines())
         self.after = '/*]]>*/\n</style>\n'
         self._render_children_as_plain_text()
 
 class CDataFilterNode(FilterNode):
+    __slots__ = ()
+
     def _render(self):
         self.before = self.spaces + '<![CDATA[%s' % (self.render_newlines())
         self.after = self.spaces + ']]>\n'
         self._render_children_as_plain_text(remove_indentation=False)
 
+# Lexers by name and HtmlFormatters by options, reused by every :highlight block
+_lexers = {}
+_formatters = {}
+
+def _get_lexer(name):
+    """Returns the lexer called `name`, None if Pygments has no such lexer"""
+    lexer = _lexers.get(name)
+    if lexer is None:
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        try:
+            lexer = _lexers[name] = get_lexer_by_name(name)
+        except ClassNotFound:
+            return None
+    return lexer
+
+def _get_formatter(options):
+    formatter = _formatters.get(options)
+    if formatter is None:
+        from pygments.formatters import HtmlFormatter
+        formatter = _formatters[options] = HtmlFormatter(**dict(options))
+    return formatter
+
 class PygmentsFilterNode(FilterNode):
+    """:highlight [lexer] [option=value ...] where the lexer is a Pygments short name such as
+    python and the options are HtmlFormatter options. The lexer is guessed from the code
+    if there is none or Pygments does not know it, which is much slower."""
+    __slots__ = ()
+
+    takes_arguments = True
+
+    # Highlighted HTML keyed on (lexer name, formatter options, code hash), shared by all compilers
+    output_cache = LRUCache(maxsize=256)
+
     def _render(self):
         if self.children:
             self.before = self.render_newlines()
             indent_offset = len(self.children[0].spaces)
             text = ''.join(''.join([c.spaces[indent_offset:], c.haml, c.render_newlines()]) for c in self.children)
-            self.before += highlight(text, guess_lexer(self.haml), HtmlFormatter())
+            self.before += self._highlight(text)
         else:
             self.after = self.render_newlines()
 
+    def _highlight(self, text):
+        lexer_name = None
+        options = []
+        for argument in self.arguments():
+            key, equals, value = argument.partition('=')
+            if not equals:
+                lexer_name = argument
+            else:
+                options.append((key, int(value) if value.isdigit() else value))
+        options = tuple(sorted(options))
+
+        source = text.encode('utf-8') if isinstance(text, unicode) else text
+        key = (lexer_name, options, hashlib.sha1(source).hexdigest())
+        html = self.output_cache.get(key)
+        if html is None:
+            from pygments import highlight
+            from pygments.lexers import guess_lexer
+            lexer = _get_lexer(lexer_name) if lexer_name else None
+            if lexer is None:
+                lexer = guess_lexer(text)
+            html = highlight(text, lexer, _get_formatter(options))
+            self.output_cache.set(key, html)
+        return html
+
+# Markdown instances of this thread keyed on their extensions, they are not thread-safe
+_markdown = threading.local()
+
 class MarkdownFilterNode(FilterNode):
+    __slots__ = ()
+
+    # Names of the Markdown extensions to use, e.g. ['markdown.extensions.tables']
+    extensions = []
+
+    # Rendered HTML keyed on (extensions, source hash), shared by all compilers
+    output_cache = LRUCache(maxsize=256)
+
     def _render(self):
         if self.children:
             self.before = self.render_newlines()[1:]
             indent_offset = len(self.children[0].spaces)
             text = ''.join(''.join([c.spaces[indent_offset:], c.haml, c.render_newlines()]) for c in self.children)
-            self.before += markdown(text)
+            self.before += self._markdown(text)
         else:
             self.after = self.render_newlines()
+
+    def _markdown(self, text):
+        extensions = tuple(filter_setting('markdown_extensions', self.extensions))
+        source = text.encode('utf-8') if isinstance(text, unicode) else text
+        key = (extensions, hashlib.sha1(source).hexdigest())
+        html = self.output_cache.get(key)
+        if html is None:
+            instances = getattr(_markdown, 'instances', None)
+            if instances is None:
+                instances = _markdown.instances = {}
+            md = instances.get(extensions)
+            if md is None:
+                from markdown import Markdown
+                # Loading the extensions is the expensive part, so the instance is reused
+                md = instances[extensions] = Markdown(extensions=list(extensions))
+            html = md.reset().convert(text)
+            self.output_cache.set(key, html)
+        return html
+
+
+# Node to create for a line, keyed on its first non-blank character
+NODE_FACTORIES = {
+    HAML_ESCAPE: lambda haml_line, stripped_line: PlaintextNode(haml_line),
+    '!': _create_doctype,
+    ELEMENT: lambda haml_line, stripped_line: ElementNode(haml_line),
+    ID: _create_inline_variable_or(ElementNode),
+    CLASS: lambda haml_line, stripped_line: ElementNode(haml_line),
+    HTML_COMMENT: _create_comment,
+    TAG: _create_tag,
+    VARIABLE: _create_variable,
+    ':': _create_filter,
+    '~': _create_typo,
+}
+
+for name in COFFEESCRIPT_FILTERS:
+    register_filter(name, CoffeeScriptFilterNode)
+for name in BARE_COFFEESCRIPT_FILTERS:
+    register_filter(name, BareCoffeeScriptFilterNode)
+register_filter(JAVASCRIPT_FILTER, JavascriptFilterNode)
+register_filter(CSS_FILTER, CssFilterNode)
+register_filter(STYLUS_FILTER, StylusFilterNode)
+register_filter(PLAIN_FILTER, PlainFilterNode)
+register_filter(PYTHON_FILTER, PythonFilterNode)
+register_filter(MARKDOWN_FILTER, MarkdownFilterNode)
+register_filter(CDATA_FILTER, CDataFilterNode)
+register_filter(PYGMENTS_FILTER, PygmentsFilterNode)
+register_filter(SASS_FILTER, SassFilterNode)
+register_filter(SCSS_FILTER, ScssFilterNode)
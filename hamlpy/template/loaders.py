@@ -1,11 +1,56 @@
 import os
+import hashlib
 
+from django.conf import settings
 from django.template import TemplateDoesNotExist
 from django.template.loaders import filesystem, app_directories
 
 from hamlpy import hamlpy
+from hamlpy import templatize  # installs the makemessages hook
+from hamlpy.cache import LRUCache, DiskCache
+from hamlpy.dependencies import DependencyGraph, template_key
+from hamlpy.nodes import filter_settings
+from hamlpy.compilers import WorkerBackend
 from hamlpy.template.utils import get_django_template_loaders
 
+# Number of compiled templates kept per loader, None for no limit and 0 to disable caching
+DEFAULT_CACHE_SIZE = 256
+
+# The settings below are read whenever a template is compiled, so they can change at run time:
+#   HAMLPY_CACHE_DIR, optional directory of compiled templates shared by all worker processes
+#   HAMLPY_COMPILER_WORKERS, long-lived worker processes for the external filters,
+#       {'coffee -sc': ['coffee-worker'], ...}
+#   HAMLPY_MARKDOWN_EXTENSIONS, names of the Markdown extensions of :markdown blocks
+
+# DiskCaches by directory and WorkerBackends by their workers, made when first needed
+_disk_caches = {}
+_worker_backends = {}
+
+
+def _disk_cache():
+    directory = getattr(settings, 'HAMLPY_CACHE_DIR', None)
+    if not directory:
+        return None
+    cache = _disk_caches.get(directory)
+    if cache is None:
+        cache = _disk_caches[directory] = DiskCache(directory)
+    return cache
+
+
+def _compiler_backend():
+    workers = getattr(settings, 'HAMLPY_COMPILER_WORKERS', None)
+    if not workers:
+        return None
+    key = repr(sorted(workers.items()))
+    backend = _worker_backends.get(key)
+    if backend is None:
+        backend = _worker_backends[key] = WorkerBackend(workers)
+    return backend
+
+
+# Which templates extend or include which, filled in as templates are compiled
+dependency_graph = DependencyGraph()
+
 
 def get_haml_loader(loader):
     if hasattr(loader, 'Loader'):
@@ -16,6 +61,15 @@ def get_haml_loader(loader):
                 return loader.load_template_source(*args, **kwargs)
 
     class Loader(baseclass):
+        # Compiled HTML keyed on (template name, template path, source hash), shared by all instances of
+        # this loader. Made by the first instance, sized by the HAMLPY_TEMPLATE_CACHE_SIZE setting.
+        cache = None
+
+        def __init__(self, *args, **kwargs):
+            super(Loader, self).__init__(*args, **kwargs)
+            if Loader.cache is None:
+                Loader.cache = LRUCache(maxsize=getattr(settings, 'HAMLPY_TEMPLATE_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+
         def load_template_source(self, template_name, *args, **kwargs):
             _name, _extension = os.path.splitext(template_name)
 
@@ -27,18 +81,44 @@ def get_haml_loader(loader):
                 except TemplateDoesNotExist:
                     pass
                 else:
-                    hamlParser = hamlpy.Compiler()
-                    html = hamlParser.process(haml_source)
-
-                    return html, template_path
+                    return self._compile(haml_source, template_path, template_name), template_path
 
             raise TemplateDoesNotExist(template_name)
 
         load_template_source.is_usable = True
 
+        def _compile(self, haml_source, template_path, template_name=None):
+            source = haml_source.encode('utf-8') if isinstance(haml_source, unicode) else haml_source
+            name = template_key(template_name or template_path)
+            key = (name, template_path, hashlib.md5(source).hexdigest())
+            html = self.cache.get(key)
+            if html is None:
+                disk_cache = _disk_cache()
+                hamlParser = hamlpy.Compiler(cache=disk_cache)
+                with filter_settings(backend=_compiler_backend(), disk_cache=disk_cache,
+                                     markdown_extensions=getattr(settings, 'HAMLPY_MARKDOWN_EXTENSIONS', None)):
+                    html = hamlParser.process(haml_source)
+                if not hamlParser.failed:
+                    self.cache.set(key, html)
+                dependency_graph.update(name, hamlParser.dependencies)
+            return html
+
         def _generate_template_name(self, name, extension="hamlpy"):
             return "%s.%s" % (name, extension)
 
+        @classmethod
+        def clear_cache(cls):
+            if cls.cache is not None:
+                cls.cache.clear()
+
+        @classmethod
+        def invalidate(cls, names):
+            if cls.cache is None:
+                return
+            for key in cls.cache.keys():
+                if key[0] in names:
+                    cls.cache.discard(key)
+
     return Loader
 
 
@@ -48,3 +128,23 @@ haml_loaders = dict((name, get_haml_loader(loader))
 
 HamlPyFilesystemLoader = get_haml_loader(filesystem)
 HamlPyAppDirectoriesLoader = get_haml_loader(app_directories)
+
+
+def _all_loaders():
+    return haml_loaders.values() + [HamlPyFilesystemLoader, HamlPyAppDirectoriesLoader]
+
+
+def clear_caches():
+    '''Drop the compiled templates held by every HamlPy loader'''
+    for loader in _all_loaders():
+        loader.clear_cache()
+
+
+def invalidate(template_name):
+    '''Drop the compiled `template_name` and every template that extends or includes it,
+    directly or not, from the caches of all HamlPy loaders. Returns the names dropped.'''
+    names = dependency_graph.affected(template_name)
+    names.add(template_key(template_name))
+    for loader in _all_loaders():
+        loader.invalidate(names)
+    return names
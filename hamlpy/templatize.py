@@ -13,7 +13,10 @@ def decorate_templatize(func):
 		html = hamlParser.process(src)
 		return func(html, origin)
 	
+	templatize.haml = True
 	return templatize
 
-trans_real.templatize = decorate_templatize(trans_real.templatize)
+# installed once, however many times this module is loaded
+if not getattr(trans_real.templatize, 'haml', False):
+	trans_real.templatize = decorate_templatize(trans_real.templatize)
 
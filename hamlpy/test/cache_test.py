@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from nose.tools import eq_
+
+from django.test.utils import override_settings
+
+from hamlpy import hamlpy, nodes, compilers, typo
+from hamlpy.cache import LRUCache, DiskCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('c'), 3)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache()
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        eq_((cache.hits, cache.misses), (1, 1))
+
+    def test_zero_size_disables_cache(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        eq_(len(cache), 0)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trips_unicode(self):
+        cache = DiskCache(self.directory)
+        key = cache.make_key(u'%p \ub9c1\ud06c')
+        cache.set(key, u'<p>\ub9c1\ud06c</p>')
+        eq_(DiskCache(self.directory).get(key), u'<p>\ub9c1\ud06c</p>')
+
+    def test_missing_key_returns_default(self):
+        eq_(DiskCache(self.directory).get('0' * 40, 'default'), 'default')
+
+    def test_expired_entries_are_ignored(self):
+        cache = DiskCache(self.directory, max_age=60)
+        cache.set('ab', u'value')
+        path = os.path.join(self.directory, 'ab', 'ab')
+        os.utime(path, (0, 0))
+        eq_(cache.get('ab'), None)
+
+    def test_value_is_returned_when_the_use_cannot_be_recorded(self):
+        cache = DiskCache(self.directory)
+        cache.set('ab', u'value')
+        def utime(path, times):
+            raise OSError(30, 'Read-only file system')
+        os_utime, os.utime = os.utime, utime
+        try:
+            eq_(cache.get('ab'), u'value')
+        finally:
+            os.utime = os_utime
+
+    def test_prune_evicts_least_recently_used(self):
+        cache = DiskCache(self.directory, max_size=10)
+        cache.set('aa', u'x' * 6)
+        cache.set('bb', u'y' * 6)
+        os.utime(os.path.join(self.directory, 'aa', 'aa'), (0, 0))
+        cache.prune()
+        eq_(cache.get('aa'), None)
+        eq_(cache.get('bb'), u'y' * 6)
+
+    def test_prune_removes_expired_entries(self):
+        cache = DiskCache(self.directory, max_size=10, max_age=60)
+        cache.set('aa', u'x' * 6)
+        cache.set('bb', u'y' * 6)
+        os.utime(os.path.join(self.directory, 'bb', 'bb'), (0, 0))
+        cache.prune()
+        eq_(os.path.exists(os.path.join(self.directory, 'bb', 'bb')), False)
+        eq_(cache.get('aa'), u'x' * 6)
+
+    def test_compiler_uses_cache(self):
+        cache = DiskCache(self.directory)
+        eq_(hamlpy.Compiler(cache=cache).process('%p hello'), '<p>hello</p>\n')
+        key = hamlpy.Compiler(cache=cache)._cache_key(['%p hello'])
+        cache.set(key, json.dumps({'html': u'cached', 'dependencies': []}))
+        eq_(hamlpy.Compiler(cache=cache).process('%p hello'), u'cached')
+
+    def test_cache_hit_restores_dependencies_without_parsing(self):
+        cache = DiskCache(self.directory)
+        template = '- extends "base.html"\n- include "nav.html"'
+        html = hamlpy.Compiler(cache=cache).process(template)
+        compiler = hamlpy.Compiler(cache=cache)
+        def parse(*args):
+            raise AssertionError('parsed on a cache hit')
+        compiler._parse = parse
+        eq_(compiler.process(template), html)
+        eq_(compiler.dependencies, ['base.html', 'nav.html'])
+
+    def test_key_depends_on_filter_and_typography_settings(self):
+        compiler = hamlpy.Compiler(cache=DiskCache(self.directory))
+        key = compiler._cache_key(['%p hello'])
+        eq_(compiler._cache_key(['%p hello']), key)
+        with nodes.filter_settings(markdown_extensions=['markdown.extensions.tables']):
+            assert compiler._cache_key(['%p hello']) != key
+        with nodes.compiler_backend(compilers.WorkerBackend({'coffee -sc': ['coffee-worker']})):
+            assert compiler._cache_key(['%p hello']) != key
+        with override_settings(HAMLPY_TYPO_LOCALE='en'):
+            assert compiler._cache_key(['%p hello']) != key
+        rulesets = dict(typo.rulesets)
+        try:
+            typo.register_ruleset('en', typo.Ruleset(glue_words=['a']))
+            assert compiler._cache_key(['%p hello']) != key
+        finally:
+            typo.rulesets.clear()
+            typo.rulesets.update(rulesets)
+        eq_(compiler._cache_key(['%p hello']), key)
@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from nose.tools import eq_
+
+from hamlpy import hamlpy, nodes, compilers
+from hamlpy.cache import LRUCache, DiskCache
+
+
+class CountingPopen(object):
+    '''Wraps subprocess.Popen to count the processes started'''
+    def __init__(self, popen):
+        self.popen = popen
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.popen(*args, **kwargs)
+
+
+class CompilerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.popen = CountingPopen(compilers.subprocess.Popen)
+        compilers.subprocess.Popen = self.popen
+        self.output_cache = nodes.CompilerNode.output_cache
+        nodes.CompilerNode.output_cache = LRUCache(maxsize=16)
+        self.node = nodes.CompilerNode(':cat')
+
+    def tearDown(self):
+        compilers.subprocess.Popen = self.popen.popen
+        nodes.CompilerNode.output_cache = self.output_cache
+        nodes.CompilerNode.disk_cache = None
+
+    def test_unchanged_source_runs_the_compiler_once(self):
+        eq_(self.node._compile(['cat'], 'a = 1\n'), ('a = 1\n', ''))
+        eq_(self.node._compile(['cat'], 'a = 1\n'), ('a = 1\n', ''))
+        eq_(self.popen.calls, 1)
+
+    def test_key_includes_command_and_source(self):
+        self.node._compile(['cat'], 'a = 1\n')
+        self.node._compile(['cat'], 'a = 2\n')
+        self.node._compile(['cat', '-'], 'a = 1\n')
+        eq_(self.popen.calls, 3)
+
+    def test_errors_are_not_cached(self):
+        self.node._compile(['sh', '-c', 'echo oops >&2'], '')
+        output, err = self.node._compile(['sh', '-c', 'echo oops >&2'], '')
+        eq_(err, 'oops\n')
+        eq_(self.popen.calls, 2)
+
+    def test_disk_cache_survives_the_process(self):
+        directory = tempfile.mkdtemp()
+        try:
+            nodes.CompilerNode.disk_cache = DiskCache(directory)
+            self.node._compile(['cat'], u'caf\xe9\n'.encode('utf-8'))
+            nodes.CompilerNode.output_cache.clear()
+            eq_(self.node._compile(['cat'], u'caf\xe9\n'.encode('utf-8')), (u'caf\xe9\n'.encode('utf-8'), ''))
+            eq_(self.popen.calls, 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+STUB_COMPILER = os.path.join(os.path.dirname(__file__), 'stub_compiler.py')
+
+TEMPLATE = '''%p before
+:coffee
+  a = 1
+%div
+  :coffee
+    fail with an error
+:sass
+  b
+:coffee
+  c = 3'''
+
+
+class RecordingBackend(object):
+    def __init__(self):
+        self.calls = []
+
+    def compile(self, blocks):
+        self.calls.append(blocks)
+        return [('/* %s */' % source.strip(), 'error' in source and 'failed' or '') for args, source in blocks]
+
+    def close(self):
+        pass
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = nodes.CompilerNode.backend
+        self.output_cache = nodes.CompilerNode.output_cache
+        nodes.CompilerNode.output_cache = LRUCache(maxsize=16)
+
+    def tearDown(self):
+        nodes.CompilerNode.backend.close()
+        nodes.CompilerNode.backend = self.backend
+        nodes.CompilerNode.output_cache = self.output_cache
+
+    def test_blocks_of_a_template_are_compiled_together(self):
+        backend = nodes.CompilerNode.backend = RecordingBackend()
+        html = hamlpy.Compiler().process(TEMPLATE)
+        eq_(backend.calls, [[
+            (['coffee', '-sc'], 'a = 1\n'),
+            (['coffee', '-sc'], 'fail with an error\n'),
+            (['sass', '-s', '--compass'], 'b\n'),
+            (['coffee', '-sc'], 'c = 3\n'),
+        ]])
+        assert '// <![CDATA[\n/* a = 1 */// ]]>' in html
+        assert 'alert("failed")' in html
+        assert '/*<![CDATA[*/\n/* b */' in html
+
+    def test_templates_with_failed_filters_are_not_cached(self):
+        backend = nodes.CompilerNode.backend = RecordingBackend()
+        directory = tempfile.mkdtemp()
+        try:
+            compiler = hamlpy.Compiler(cache=DiskCache(directory))
+            compiler.process(TEMPLATE)
+            eq_(compiler.failed, True)
+            # Rendered again, only the failed block is compiled again
+            compiler.process(TEMPLATE)
+            eq_(backend.calls[1], [(['coffee', '-sc'], 'fail with an error\n')])
+
+            compiler.process(':coffee\n  d = 4')
+            eq_(compiler.failed, False)
+            nodes.CompilerNode.output_cache.clear()
+            compiler.process(':coffee\n  d = 4')
+            eq_(len(backend.calls), 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stream_batches_each_window(self):
+        backend = nodes.CompilerNode.backend = RecordingBackend()
+        html = ''.join(hamlpy.Compiler().process_stream(TEMPLATE.splitlines()))
+        eq_(html, hamlpy.Compiler().process(TEMPLATE))
+
+    def test_worker_backend(self):
+        args = nodes.CoffeeScriptFilterNode.args
+        popen = CountingPopen(compilers.subprocess.Popen)
+        compilers.subprocess.Popen = popen
+        try:
+            nodes.CompilerNode.backend = compilers.WorkerBackend({
+                tuple(args): [sys.executable, STUB_COMPILER, '--worker']})
+            html = hamlpy.Compiler().process(TEMPLATE.replace(':sass\n  b\n', ''))
+            nodes.CompilerNode.output_cache.clear()
+            html += hamlpy.Compiler().process(':coffee\n  d = 4')
+        finally:
+            compilers.subprocess.Popen = popen.popen
+        eq_(popen.calls, 1)
+        pids = set(re.findall(r'// (\d+)\n', html))
+        eq_(len(pids), 1)
+        for js in ('A = 1', 'C = 3', 'D = 4', 'alert("cannot compile fail with an error")'):
+            assert js in html, js
+
+    def test_worker_is_restarted(self):
+        nodes.CompilerNode.backend = backend = compilers.WorkerBackend({
+            ('stub',): [sys.executable, STUB_COMPILER, '--worker']})
+        eq_(backend.compile([(['stub'], 'x')])[0][0].split('\n')[1], 'X')
+        backend._processes.values()[0].kill()
+        backend._processes.values()[0].wait()
+        eq_(backend.compile([(['stub'], 'y')])[0][0].split('\n')[1], 'Y')
+
+    def test_hung_worker_is_restarted_and_the_block_compiled_without_it(self):
+        fallback = RecordingBackend()
+        nodes.CompilerNode.backend = backend = compilers.WorkerBackend({
+            ('stub',): [sys.executable, STUB_COMPILER, '--worker']}, fallback=fallback, timeout=1)
+        pid = backend.compile([(['stub'], 'x')])[0][0].split('\n')[0]
+        eq_(backend.compile([(['stub'], 'hang'), (['stub'], 'y')])[0], ('/* hang */', ''))
+        eq_(fallback.calls, [[(['stub'], 'hang')]])
+        output = backend.compile([(['stub'], 'z')])[0][0]
+        assert output.endswith('Z') and not output.startswith(pid), output
+
+    def test_malformed_answers_are_compiled_without_the_worker(self):
+        fallback = RecordingBackend()
+        nodes.CompilerNode.backend = backend = compilers.WorkerBackend({
+            ('stub',): [sys.executable, STUB_COMPILER, '--worker']}, fallback=fallback)
+        blocks = [(['stub'], reply) for reply in
+                  ('reply []', 'reply "x"', 'reply {"output": null}', 'reply {"output": "x", "error": 1}')]
+        eq_(backend.compile(blocks), RecordingBackend().compile(blocks))
+        eq_(fallback.calls, [blocks])
+        eq_(backend.compile([(['stub'], 'reply {"output": "x"}')]), [('x', '')])
+
+    def test_workers_of_different_compilers_run_at_once(self):
+        # Each block only finishes once both workers have started compiling
+        nodes.CompilerNode.backend = backend = compilers.WorkerBackend({
+            ('a',): [sys.executable, STUB_COMPILER, '--worker'],
+            ('b',): [sys.executable, '-u', STUB_COMPILER, '--worker']})
+        directory = tempfile.mkdtemp()
+        results = {}
+        def compile(args):
+            results[args] = backend.compile([([args], 'wait %s 2' % directory)])[0]
+        try:
+            threads = [threading.Thread(target=compile, args=(args,)) for args in ('a', 'b')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            shutil.rmtree(directory)
+        eq_(sorted(error for output, error in results.values()), ['', ''])
+
+    def test_close_kills_workers_that_ignore_eof(self):
+        nodes.CompilerNode.backend = backend = compilers.WorkerBackend({
+            ('stub',): [sys.executable, STUB_COMPILER, '--worker', '--ignore-eof']})
+        backend.compile([(['stub'], 'x')])
+        proc = backend._processes.values()[0]
+        backend.close(timeout=0.1)
+        assert proc.poll() is not None
+
+    def test_unmapped_commands_run_once_per_block(self):
+        backend = compilers.WorkerBackend({})
+        stub = [sys.executable, STUB_COMPILER]
+        eq_(backend.compile([(stub, 'x'), (stub, 'error')]), [('X', ''), ('', 'cannot compile error')])
+
+
+class ConcurrentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = nodes.CoffeeScriptFilterNode.args
+        nodes.CoffeeScriptFilterNode.args = [sys.executable, STUB_COMPILER]
+        self.output_cache = nodes.CompilerNode.output_cache
+        nodes.CompilerNode.output_cache = LRUCache(maxsize=0)
+
+    def tearDown(self):
+        nodes.CoffeeScriptFilterNode.args = self.args
+        nodes.CompilerNode.output_cache = self.output_cache
+
+    def test_same_output_as_serial(self):
+        template = TEMPLATE.replace(':sass\n  b\n', '')
+        eq_(hamlpy.Compiler().process_concurrent(template), hamlpy.Compiler().process(template))
+
+    def test_blocks_run_at_once(self):
+        # Each block only finishes once all four compilers have started
+        directory = tempfile.mkdtemp()
+        try:
+            template = '\n'.join(':coffee\n  wait %s 4' % directory for i in range(4))
+            html = hamlpy.Compiler().process_concurrent(template, max_processes=4)
+        finally:
+            shutil.rmtree(directory)
+        assert 'alert' not in html
+        eq_(html.count('WAIT %s 4' % directory.upper()), 4)
+
+    def test_timeout(self):
+        html = hamlpy.Compiler().process_concurrent(':coffee\n  hang\n:coffee\n  a', timeout=1)
+        assert 'alert("%s timed out after 1 seconds")' % sys.executable in html
+        assert '\nA\n' in html
+
+    def test_missing_compiler_raises(self):
+        nodes.CoffeeScriptFilterNode.args = ['hamlpy-no-such-compiler']
+        self.assertRaises(OSError, hamlpy.Compiler().process_concurrent, ':coffee\n  a\n:coffee\n  b')
@@ -0,0 +1,63 @@
+import unittest
+from nose.tools import eq_
+
+from hamlpy import hamlpy
+from hamlpy.dependencies import DependencyGraph
+
+
+def _dependencies(haml):
+    compiler = hamlpy.Compiler()
+    compiler.process(haml)
+    return compiler.dependencies
+
+
+class FindDependenciesTest(unittest.TestCase):
+
+    def test_extends_and_include(self):
+        haml = '- extends "base.html"\n- block content\n  - include \'partials/nav.html\' with active="home"\n  - include "partials/nav.html"'
+        eq_(_dependencies(haml), ['base.html', 'partials/nav.html'])
+
+    def test_ignores_names_held_in_variables(self):
+        eq_(_dependencies('- extends layout\n- include partial_name'), [])
+
+    def test_ignores_filter_content(self):
+        eq_(_dependencies(':plain\n  - include "partial.html"'), [])
+
+    def test_other_tags(self):
+        eq_(_dependencies('- load "include.html"\n%p include'), [])
+
+    def test_stream(self):
+        compiler = hamlpy.Compiler()
+        list(compiler.process_stream(['- extends "base.html"', '%p', '- include "nav.html"']))
+        eq_(compiler.dependencies, ['base.html', 'nav.html'])
+
+
+class DependencyGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = DependencyGraph()
+        self.graph.update('base.haml', [])
+        self.graph.update('layout.haml', ['base.html'])
+        self.graph.update('page.haml', ['layout.html', 'partials/nav.html'])
+        self.graph.update('other.haml', ['partials/nav.html'])
+
+    def test_direct(self):
+        eq_(self.graph.dependencies('page.html'), set(['layout', 'partials/nav']))
+        eq_(self.graph.dependents('partials/nav.html'), set(['page', 'other']))
+
+    def test_affected_is_transitive(self):
+        eq_(self.graph.affected('base.html'), set(['layout', 'page']))
+        eq_(self.graph.affected('page.html'), set())
+
+    def test_update_replaces_dependencies(self):
+        self.graph.update('page.haml', ['base.html'])
+        eq_(self.graph.dependents('layout'), set())
+        eq_(self.graph.affected('base'), set(['layout', 'page']))
+
+    def test_remove(self):
+        self.graph.remove('layout')
+        eq_(self.graph.affected('base'), set())
+
+    def test_cycles_terminate(self):
+        self.graph.update('base.haml', ['page.html'])
+        eq_(self.graph.affected('base'), set(['layout', 'page']))
@@ -81,5 +81,28 @@ class TestElementNode(unittest.TestCase):
             self.assertEqual(root.parent_of(el['node']), eval(el['expected_parent']))
             root.add_node(el['node'])
 
+    def test_nodes_have_no_instance_dict(self):
+        for haml in ('%div', 'text', '- if a', '= var', ':plain', '/ comment', '!!!'):
+            self.assertFalse(hasattr(nodes.create_node(haml), '__dict__'), haml)
+
+    def test_indentation_strings_are_shared(self):
+        self.assertTrue(nodes.HamlNode('    %a').spaces is nodes.HamlNode('    %b').spaces)
+
+    def test_render_keeps_only_what_post_render_needs(self):
+        node = nodes.ElementNode('  %p< text')
+        node._render_node()
+        self.assertEqual(None, node.raw_haml)
+        self.assertTrue(node.nuke_inner_whitespace)
+        self.assertFalse(node.nuke_outer_whitespace)
+
+    def test_siblings_are_linked(self):
+        parent = nodes.ElementNode('%ul')
+        first, second, third = [nodes.ElementNode('  %li') for i in range(3)]
+        for child in (first, second, third):
+            parent.add_child(child)
+        self.assertEqual((None, second), (first.left_sibling(), first.right_sibling()))
+        self.assertEqual((first, third), (second.left_sibling(), second.right_sibling()))
+        self.assertEqual((second, None), (third.left_sibling(), third.right_sibling()))
+
 if __name__ == "__main__":
     unittest.main()
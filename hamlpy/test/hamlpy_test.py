@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import sys
 import unittest
 from nose.tools import eq_, raises
 from hamlpy import hamlpy
@@ -100,6 +101,56 @@ class HamlPyTest(unittest.TestCase):
         result = hamlParser.process(haml)
         eq_(html, result)
     
+    def test_else_closes_deeper_nesting(self):
+        haml = '- if a\n  - for b in c\n    %p= b\n- else\n  none'
+        html = '{% if a %}\n  {% for b in c %}\n    <p>{{ b }}</p>\n  {% endfor %}\n{% else %}\n  none\n{% endif %}\n'
+        hamlParser = hamlpy.Compiler()
+        result = hamlParser.process(haml)
+        eq_(html, result)
+
+    def test_filter_captures_all_deeper_lines(self):
+        haml = '%div\n  :plain\n    %p not an element\n      - if not a tag\n  %p after'
+        html = '<div>\n%p not an element\n  - if not a tag\n  <p>after</p>\n</div>\n'
+        hamlParser = hamlpy.Compiler()
+        result = hamlParser.process(haml)
+        eq_(html, result)
+
+    def test_deep_nesting_does_not_recurse(self):
+        depth = sys.getrecursionlimit() + 100
+        haml = '\n'.join(' ' * i + '%b' for i in range(depth))
+        hamlParser = hamlpy.Compiler()
+        result = hamlParser.process(haml)
+        eq_(depth, result.count('<b>'))
+        eq_(depth, result.count('</b>'))
+
+    def test_multiline_dict_ignores_braces_in_strings(self):
+        haml = "%a{'href': '/{x',\n   'title': 'a } b'} link\n%p next"
+        html = "<a href='/{x' title='a } b'>link</a>\n<p>next</p>\n"
+        hamlParser = hamlpy.Compiler()
+        result = hamlParser.process(haml)
+        eq_(html, result)
+
+    def test_brace_tracker_skips_inline_variables_and_strings(self):
+        eq_(0, hamlpy.BraceTracker().feed("Hello #{name, {% if a %}"))
+        eq_(1, hamlpy.BraceTracker().feed("%a{'title': '}',"))
+        braces = hamlpy.BraceTracker()
+        braces.feed("%a{'title': 'it\\'s {',")
+        eq_(0, braces.feed("  'href': '#{url}'} text {{ x }}"))
+
+    def test_quotes_outside_attribute_dicts_are_text(self):
+        haml = "%p\n  Set { it's\n  here }\n%script\n  var a = {\n  // it's\n  };\n%p after"
+        html = "<p>\n  Set { it's  here }\n</p>\n<script>\n  var a = {  // it's  };\n</script>\n<p>after</p>\n"
+        hamlParser = hamlpy.Compiler()
+        result = hamlParser.process(haml)
+        eq_(html, result)
+        eq_(1, hamlpy.BraceTracker().feed("%p{'a': 'b'} it's {"))
+
+    @raises(Exception)
+    def test_multiline_dict_without_closing_brace(self):
+        haml = "%a{'title': 'x',\n   'href': '}'\n%p next"
+        hamlParser = hamlpy.Compiler()
+        hamlParser.process(haml)
+
     @raises(TypeError)   
     def test_throws_exception_when_trying_to_close_django(self):
         haml = '- endfor'
@@ -0,0 +1,46 @@
+import unittest
+from nose.tools import eq_
+
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import PythonLexer, guess_lexer
+
+from hamlpy import hamlpy, nodes
+from hamlpy.cache import LRUCache
+
+CODE = 'if x:\n    print "y"\n'
+
+
+class HighlightFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_cache = nodes.PygmentsFilterNode.output_cache
+        nodes.PygmentsFilterNode.output_cache = LRUCache(maxsize=16)
+
+    def tearDown(self):
+        nodes.PygmentsFilterNode.output_cache = self.output_cache
+
+    def test_explicit_lexer(self):
+        html = hamlpy.Compiler().process(':highlight python\n  if x:\n      print "y"')
+        eq_(html, '\n' + highlight(CODE, PythonLexer(), HtmlFormatter()))
+
+    def test_formatter_options(self):
+        html = hamlpy.Compiler().process(':highlight python linenos=table cssclass=code\n  if x:\n      print "y"')
+        eq_(html, '\n' + highlight(CODE, PythonLexer(), HtmlFormatter(linenos='table', cssclass='code')))
+
+    def test_output_is_cached(self):
+        haml = ':highlight python\n  a = 1\n%p\n:highlight python\n  a = 1\n:highlight\n  a = 1'
+        hamlpy.Compiler().process(haml)
+        cache = nodes.PygmentsFilterNode.output_cache
+        eq_((cache.hits, cache.misses), (1, 2))
+
+    def test_formatters_are_shared(self):
+        hamlpy.Compiler().process(':highlight python nowrap=1\n  a\n:highlight python nowrap=1\n  b')
+        eq_(nodes._formatters[(('nowrap', 1),)].nowrap, True)
+
+    def test_other_filters_do_not_take_arguments(self):
+        eq_(hamlpy.Compiler().process(':plain python\n  a'), ':plain python\n  a\n')
+
+    def test_unknown_lexer_is_guessed(self):
+        html = hamlpy.Compiler().process(':highlight no-such-language\n  if x:\n      print "y"')
+        eq_(html, '\n' + highlight(CODE, guess_lexer(CODE), HtmlFormatter()))
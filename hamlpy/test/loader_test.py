@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from nose.tools import eq_
+
+from django.template import TemplateDoesNotExist
+from django.test.utils import override_settings
+
+from hamlpy import nodes
+from hamlpy.template import loaders
+from hamlpy.template.loaders import get_haml_loader
+
+
+class DictLoader(object):
+    '''Stands in for a Django loader module, serving templates from a dict'''
+    def __init__(self, templates):
+        self.templates = templates
+        self.calls = 0
+
+    def load_template_source(self, template_name, *args, **kwargs):
+        self.calls += 1
+        try:
+            return self.templates[template_name], 'memory:' + template_name
+        except KeyError:
+            raise TemplateDoesNotExist(template_name)
+
+
+class LoaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.templates = {'page.haml': u'%p hello'}
+        self.Loader = get_haml_loader(DictLoader(self.templates))
+
+    def test_compiles_once_for_unchanged_source(self):
+        loader = self.Loader()
+        eq_(loader.load_template_source('page.html')[0], u'<p>hello</p>\n')
+        eq_(loader.load_template_source('page.html')[0], u'<p>hello</p>\n')
+        eq_((self.Loader.cache.hits, self.Loader.cache.misses), (1, 1))
+
+    def test_recompiles_when_source_changes(self):
+        loader = self.Loader()
+        loader.load_template_source('page.html')
+        self.templates['page.haml'] = u'%p goodbye'
+        eq_(loader.load_template_source('page.html')[0], u'<p>goodbye</p>\n')
+
+    def test_clear_cache(self):
+        loader = self.Loader()
+        loader.load_template_source('page.html')
+        self.Loader.clear_cache()
+        eq_(len(self.Loader.cache), 0)
+
+    def test_cache_size_is_read_when_first_used(self):
+        eq_(self.Loader.cache, None)
+        with override_settings(HAMLPY_TEMPLATE_CACHE_SIZE=3):
+            self.Loader()
+        eq_(self.Loader.cache.maxsize, 3)
+
+    def test_filter_settings_are_read_when_compiling(self):
+        self.templates['table.haml'] = u':markdown\n  a | b\n  --|--\n  1 | 2'
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(HAMLPY_MARKDOWN_EXTENSIONS=['markdown.extensions.tables'],
+                                   HAMLPY_CACHE_DIR=directory):
+                html = self.Loader().load_template_source('table.html')[0]
+            assert os.listdir(directory)
+        finally:
+            shutil.rmtree(directory)
+        assert '<table>' in html
+        eq_(nodes.MarkdownFilterNode.extensions, [])
+
+    def test_templates_with_failed_filters_are_not_cached(self):
+        self.templates['page.haml'] = u':coffee\n  a = 1'
+        args = nodes.CoffeeScriptFilterNode.args
+        nodes.CoffeeScriptFilterNode.args = ['sh', '-c', 'echo not installed >&2']
+        try:
+            self.Loader().load_template_source('page.html')
+        finally:
+            nodes.CoffeeScriptFilterNode.args = args
+        eq_(len(self.Loader.cache), 0)
+
+    def test_invalidate_drops_dependents(self):
+        self.templates.update({
+            'base.haml': u'%body\n  - block content',
+            'layout.haml': u'- extends "base.html"',
+            'other.haml': u'%p other',
+        })
+        loader = self.Loader()
+        for name in ('page.html', 'base.html', 'layout.html', 'other.html'):
+            loader.load_template_source(name)
+        self.templates['page.haml'] = u'- extends "layout.html"'
+        loader.load_template_source('page.html')
+
+        names = loaders.invalidate('base.html')
+        eq_(names, set(['base', 'layout', 'page']))
+        # Loaders made in tests are not known to the module
+        self.Loader.invalidate(names)
+        eq_(sorted(key[0] for key in self.Loader.cache.keys()), ['other'])
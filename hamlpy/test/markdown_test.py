@@ -0,0 +1,65 @@
+import threading
+import unittest
+from nose.tools import eq_
+
+from markdown import markdown
+
+from hamlpy import hamlpy, nodes
+from hamlpy.cache import LRUCache
+
+HAML = ''':markdown
+  # Title
+
+  | a | b |
+  |---|---|
+  | 1 | 2 |
+%p
+:markdown
+  Some *text*[^1]
+
+  [^1]: A footnote'''
+
+
+class MarkdownFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_cache = nodes.MarkdownFilterNode.output_cache
+        nodes.MarkdownFilterNode.output_cache = LRUCache(maxsize=16)
+
+    def tearDown(self):
+        nodes.MarkdownFilterNode.output_cache = self.output_cache
+        nodes.MarkdownFilterNode.extensions = []
+
+    def test_same_output_as_markdown_function(self):
+        html = hamlpy.Compiler().process(':markdown\n  # Title\n\n  Some *text*')
+        eq_(html, markdown('# Title\n\nSome *text*\n'))
+
+    def test_extensions(self):
+        nodes.MarkdownFilterNode.extensions = ['markdown.extensions.tables', 'markdown.extensions.footnotes']
+        html = hamlpy.Compiler().process(HAML)
+        assert '<table>' in html
+        assert 'class="footnote"' in html
+
+        nodes.MarkdownFilterNode.extensions = []
+        assert '<table>' not in hamlpy.Compiler().process(HAML)
+
+    def test_instance_is_reset_between_blocks(self):
+        nodes.MarkdownFilterNode.extensions = ['markdown.extensions.footnotes']
+        html = hamlpy.Compiler().process(':markdown\n  a[^1]\n\n  [^1]: one\n:markdown\n  b')
+        eq_(html.count('class="footnote"'), 1)
+
+    def test_output_is_cached(self):
+        hamlpy.Compiler().process(':markdown\n  *a*\n:markdown\n  *a*\n:markdown\n  *b*')
+        cache = nodes.MarkdownFilterNode.output_cache
+        eq_((cache.hits, cache.misses), (1, 2))
+
+    def test_one_instance_per_thread(self):
+        hamlpy.Compiler().process(':markdown\n  *a*')
+        instances = []
+        def compile():
+            hamlpy.Compiler().process(':markdown\n  *b*')
+            instances.extend(nodes._markdown.instances.values())
+        thread = threading.Thread(target=compile)
+        thread.start()
+        thread.join()
+        assert instances[0] is not nodes._markdown.instances[()]
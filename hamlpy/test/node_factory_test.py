@@ -64,3 +64,44 @@ class TestNodeFactory():
         node = nodes.create_node('/[if IE 5]')
         assert isinstance(node, nodes.ConditionalCommentNode)
         
+
+    def test_unknown_filter_is_plain_text(self):
+        node = nodes.create_node(':no-such-filter')
+        assert isinstance(node, nodes.PlaintextNode)
+
+        node = nodes.create_node('::javascript')
+        assert isinstance(node, nodes.PlaintextNode)
+
+    def test_registered_filter_class(self):
+        class ShoutFilterNode(nodes.PlainFilterNode):
+            pass
+        nodes.register_filter(':shout', ShoutFilterNode)
+        try:
+            assert isinstance(nodes.create_node('  :shout'), ShoutFilterNode)
+        finally:
+            del nodes.FILTERS['shout']
+
+    def test_registered_filter_is_imported_on_first_use(self):
+        nodes.register_filter('lazy', 'hamlpy.nodes:CDataFilterNode')
+        try:
+            assert nodes.FILTERS['lazy'] == 'hamlpy.nodes:CDataFilterNode'
+            node = nodes.create_node(':lazy')
+            assert isinstance(node, nodes.CDataFilterNode)
+            assert nodes.FILTERS['lazy'] is node.__class__
+        finally:
+            del nodes.FILTERS['lazy']
+
+    def test_entry_point_filter_is_loaded_on_first_use(self):
+        class FakeEntryPoint(object):
+            loads = 0
+            def load(self):
+                self.loads += 1
+                return nodes.PlainFilterNode
+        entry_point = FakeEntryPoint()
+        nodes.FILTERS['from-entry-point'] = entry_point
+        try:
+            assert isinstance(nodes.create_node(':from-entry-point'), nodes.PlainFilterNode)
+            assert isinstance(nodes.create_node(':from-entry-point'), nodes.PlainFilterNode)
+            assert entry_point.loads == 1
+        finally:
+            del nodes.FILTERS['from-entry-point']
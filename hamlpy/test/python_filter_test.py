@@ -0,0 +1,77 @@
+import sys
+import threading
+import unittest
+from StringIO import StringIO
+from nose.tools import eq_
+
+from hamlpy import hamlpy, nodes
+from hamlpy.cache import LRUCache
+
+
+class PythonFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.code_cache = nodes.PythonFilterNode.code_cache
+        self.output_cache = nodes.PythonFilterNode.output_cache
+        nodes.PythonFilterNode.code_cache = LRUCache(maxsize=16)
+        nodes.PythonFilterNode.output_cache = LRUCache(maxsize=16)
+
+    def tearDown(self):
+        nodes.PythonFilterNode.code_cache = self.code_cache
+        nodes.PythonFilterNode.output_cache = self.output_cache
+
+    def test_does_not_touch_sys_stdout(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            html = hamlpy.Compiler().process(':python\n  import sys\n  print "a", sys.stdout is sys.__stdout__\n  print')
+            replaced = sys.stdout
+        finally:
+            sys.stdout = stdout
+        eq_(html, 'a False\n\n')
+        eq_(replaced.getvalue(), '')
+
+    def test_print_function(self):
+        html = hamlpy.Compiler().process(':python\n  from __future__ import print_function\n  print("a", "b", sep="-")')
+        eq_(html, 'a-b\n')
+
+    def test_explicit_destination_is_kept(self):
+        html = hamlpy.Compiler().process(':python\n  import sys\n  print >>sys.stderr, "",\n  print "a"')
+        eq_(html, 'a\n')
+
+    def test_code_is_compiled_once(self):
+        haml = ':python\n  print 1\n:python\n  print 1'
+        eq_(hamlpy.Compiler().process(haml), '1\n1\n')
+        cache = nodes.PythonFilterNode.code_cache
+        eq_((cache.hits, cache.misses), (1, 1))
+
+    def test_deterministic_output_is_cached(self):
+        haml = ':python deterministic\n  calls.append(1)\n  print len(calls)'
+        __builtins__['calls'] = []
+        try:
+            eq_(hamlpy.Compiler().process(haml), '1\n')
+            eq_(hamlpy.Compiler().process(haml), '1\n')
+            eq_(hamlpy.Compiler().process(haml.replace(' deterministic', '')), '2\n')
+        finally:
+            del __builtins__['calls']
+
+    def test_error_message(self):
+        try:
+            hamlpy.Compiler().process(':python\n  raise ValueError("oops")')
+        except ValueError, e:
+            eq_(e.args[0], 'Error in :python filter code: oops')
+        else:
+            self.fail('no exception')
+
+    def test_threads_keep_their_own_output(self):
+        results = {}
+        def compile(n):
+            haml = ':python\n  import time\n  for i in range(20):\n    print %d,\n    time.sleep(0.0005)' % n
+            results[n] = hamlpy.Compiler().process(haml)
+        threads = [threading.Thread(target=compile, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(8):
+            eq_(results[n], ' '.join([str(n)] * 20))
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+import subprocess
+from nose.tools import eq_
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+CHECK_MODULES = '''
+import sys
+import hamlpy.hamlpy
+print sorted(name for name in ('django', 'pygments', 'markdown', 'html5lib', 'colorama', 'hamlpy.typo')
+             if name in sys.modules)
+print hamlpy.hamlpy.Compiler().process(u'%p\\n  ~ a - b').encode('utf-8')
+print sorted(name for name in ('django', 'hamlpy.typo') if name in sys.modules)
+'''
+
+CHECK_TEMPLATIZE = '''
+import hamlpy
+from django.conf import settings
+settings.configure(INSTALLED_APPS=[%s])
+import django
+django.setup()
+%s
+from django.utils.translation import trans_real
+print trans_real.templatize('%%p {%% trans "Hello" %%}')
+'''
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    proc = subprocess.Popen([sys.executable, '-c', code], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, err = proc.communicate()
+    eq_(err, '')
+    return output
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_optional_modules_are_imported_when_used(self):
+        output = run(CHECK_MODULES)
+        eq_(output.decode('utf-8').split('\n'), [
+            u'[]',
+            u'<p>',
+            u'  a\u00a0\u2014 b',
+            u'</p>',
+            u'',
+            u"['hamlpy.typo']",
+            u'',
+        ])
+
+    def test_templatize_hook_is_installed_by_the_app(self):
+        eq_(run(CHECK_TEMPLATIZE % ("'hamlpy'", '')), 'XXX gettext(u\'Hello\') XXXX\n\n')
+
+    def test_templatize_hook_is_installed_by_the_loaders(self):
+        eq_(run(CHECK_TEMPLATIZE % ('', 'import hamlpy.template.loaders')), 'XXX gettext(u\'Hello\') XXXX\n\n')
@@ -0,0 +1,36 @@
+import io
+import unittest
+from nose.tools import eq_
+from hamlpy import hamlpy
+
+
+class StreamTest(unittest.TestCase):
+
+    def _compare(self, haml):
+        expected = hamlpy.Compiler().process(haml)
+        chunks = list(hamlpy.Compiler().process_stream(io.StringIO(haml)))
+        eq_(expected, u''.join(chunks))
+        return chunks
+
+    def test_matches_process(self):
+        self._compare(u'%ul\n  %li one\n  %li two\n\n%p after\n')
+        self._compare(u'- if a\n  %p a\n- else\n  %p b\n%div')
+        self._compare(u'')
+
+    def test_outer_whitespace_removal_between_top_level_nodes(self):
+        self._compare(u'%li one\n%li> two\n%li three\n%li> four')
+
+    def test_emits_closed_top_level_nodes_early(self):
+        consumed = []
+        def lines():
+            for i in range(100):
+                consumed.append(i)
+                yield u'%%p %d\n' % i
+        chunks = hamlpy.Compiler().process_stream(lines())
+        eq_(u'<p>0</p>\n', chunks.next())
+        assert len(consumed) < 10
+
+    def test_writes_to_writable(self):
+        out = io.StringIO()
+        hamlpy.Compiler().process_stream(io.StringIO(u'%p one\n%p two'), out)
+        eq_(u'<p>one</p>\n<p>two</p>\n', out.getvalue())
@@ -0,0 +1,50 @@
+'''Stands in for an external compiler in the tests.
+
+Run without arguments it compiles stdin to stdout once. With --worker it speaks the
+hamlpy.compilers.WorkerBackend protocol and starts its output with its process id.
+Compiling upper-cases the source, a source containing "error" fails and one containing
+"hang" takes five seconds. A source "wait DIRECTORY COUNT" registers the compiler in
+DIRECTORY and only finishes once COUNT compilers have registered there, failing if that
+does not happen within ten seconds. A worker sent "reply LINE" answers with LINE instead, and
+one started with --worker --ignore-eof keeps running for a minute after its stdin closes.
+'''
+import os
+import sys
+import json
+import time
+
+
+def compile_source(source):
+    if 'error' in source:
+        return '', 'cannot compile %s' % source.strip()
+    if source.startswith('wait '):
+        directory, count = source.split()[1:3]
+        open(os.path.join(directory, str(os.getpid())), 'w').close()
+        deadline = time.time() + 10
+        while len(os.listdir(directory)) < int(count):
+            if time.time() > deadline:
+                return '', 'only %d of %s compilers started' % (len(os.listdir(directory)), count)
+            time.sleep(0.01)
+    if 'hang' in source:
+        time.sleep(5)
+    return source.upper(), ''
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        for line in iter(sys.stdin.readline, ''):
+            source = json.loads(line)['source']
+            if source.startswith('reply '):
+                sys.stdout.write(source[len('reply '):] + '\n')
+                sys.stdout.flush()
+                continue
+            output, error = compile_source(source)
+            output = '// %d\n%s' % (os.getpid(), output)
+            sys.stdout.write(json.dumps({'output': output, 'error': error}) + '\n')
+            sys.stdout.flush()
+        if '--ignore-eof' in sys.argv:
+            time.sleep(60)
+    else:
+        output, error = compile_source(sys.stdin.read())
+        sys.stdout.write(output)
+        sys.stderr.write(error)
@@ -6,10 +6,10 @@ from hamlpy import hamlpy
 class TestTemplateCompare(unittest.TestCase):
 
     def test_nuke_inner_whitespace(self):
-        self._compare_test_files('nukeInnerWhitespace')
+        self._compare_test_files('nukeInnerWhiteSpace')
 
     def test_nuke_outer_whitespace(self):
-        self._compare_test_files('nukeOuterWhitespace')
+        self._compare_test_files('nukeOuterWhiteSpace')
 
     def test_comparing_simple_templates(self):
         self._compare_test_files('simple')
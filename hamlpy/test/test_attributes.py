@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import re
+from types import NoneType
+
+from nose.tools import eq_, raises
+
+from hamlpy.attributes import AttributeParser, parse_attribute_dictionary
+
+
+# Frozen copy of the eval based attribute parser the hand-written one replaced,
+# kept so that both can be compared on the same input.
+
+class ObjectHack(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, name):
+        return ObjectHack("%s.%s" % (self._name, name))
+
+class LocalsHack(dict):
+
+    def __getitem__(self, name):
+        return ObjectHack(name)
+
+_ATTRIBUTE_KEY_REGEX = r'(?P<key>[a-zA-Z_][a-zA-Z0-9_-]*)'
+_SINGLE_QUOTE_STRING_LITERAL_REGEX = r"'([^'\\]*(?:\\.[^'\\]*)*)'"
+_DOUBLE_QUOTE_STRING_LITERAL_REGEX = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+_ATTRIBUTE_VALUE_REGEX = r'(?P<val>\d+|None(?![A-Za-z0-9_])|%s|%s)'%(_SINGLE_QUOTE_STRING_LITERAL_REGEX, _DOUBLE_QUOTE_STRING_LITERAL_REGEX)
+
+RUBY_HAML_REGEX = re.compile(r'(:|\")%s(\"|) =>'%(_ATTRIBUTE_KEY_REGEX))
+ATTRIBUTE_REGEX = re.compile(r'(?P<pre>\{\s*|,\s*)%s:\s*%s'%(_ATTRIBUTE_KEY_REGEX, _ATTRIBUTE_VALUE_REGEX))
+
+def _legacy_escape_attribute_quotes(v):
+    '''
+    Escapes quotes with a backslash, except those inside a Django tag
+    '''
+    escaped=[]
+    inside_tag = False
+    for i, _ in enumerate(v):
+        if v[i:i+2] == '{%':
+            inside_tag=True
+        elif v[i:i+2] == '%}':
+            inside_tag=False
+
+        if v[i]=="'" and not inside_tag:
+            escaped.append('\\')
+
+        escaped.append(v[i])
+
+    return ''.join(escaped)
+
+def legacy_parse_attribute_dictionary(attribute_dict_string):
+    attributes = ''
+    if isinstance(attribute_dict_string, unicode):
+        attribute_dict_string = attribute_dict_string.encode("utf-8")
+    attributes_dict = {}
+    if (attribute_dict_string):
+        attribute_dict_string = attribute_dict_string.replace('\n', ' ')
+        try:
+
+            # grab conditional attributes
+            # conditional match is:
+            #  attrname: if(condition)
+            #  attrname: unless(condition)
+            # means `attrname` will present only if `condition` evaluates to `True`
+            # or `False` for unless case
+            # useful for attributes like "checked", "required" etc
+            conditional_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(if|unless)\(\s*([\w=\s\.]+?)\s*\)", attribute_dict_string)
+            # remove conditional matches from attribute string
+            attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*(?:if|unless)\(\s*[\w=\s\.]+?\s*\)\s*,?", "\\1", attribute_dict_string)
+
+            # grab conditional presence attributes
+            # conditional presence is:
+            #  attrname: if(condition, value)
+            #  attrname: unless(condition, value)
+            # means `attrname` will present and have `value` only if `condition` evaluates to `True`
+            # of `False` for unless case
+            # useful for adding "class" and "id"
+            conditional_presence_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(if|unless)\(\s*([\w=\s\.]+?)\s*,\s*(.+?)\s*\)", attribute_dict_string)
+            # remove conditional presence matches from attribute string
+            attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*(?:if|unless)\(\s*[\w=\s\.]+\s*,\s*.+?\s*\)\s*,?", "\\1", attribute_dict_string)
+
+            # grab tag call attributes
+            # tag call attribute is:
+            #   attrname: tagname(arguments)
+            # will render to attrname='{% tagname arguments %}'
+            # useful for "href" attributes
+            tag_call_matches = re.findall(r"[,\{]\s*([\w-]+)\:\s*(\w+)\(\s*(.+?)\s*\)\s*[\},]", attribute_dict_string)
+            # remove tag call matches from attribute string
+            attribute_dict_string = re.sub(r"([,\{])\s*[\w-]+\:\s*\w+\(\s*.+?\s*\)\s*,?", "\\1", attribute_dict_string)
+
+            # converting all allowed attributes to python dictionary style
+
+            # Replace Ruby-style HAML with Python style
+            attribute_dict_string = re.sub(RUBY_HAML_REGEX, '"\g<key>":',attribute_dict_string)
+            # Put double quotes around key
+            attribute_dict_string = re.sub(ATTRIBUTE_REGEX, '\g<pre>"\g<key>":\g<val>', attribute_dict_string)
+            # Parse string as dictionary
+
+            # use hacked locals to allow literal django variables as values
+            attributes_dict = eval(attribute_dict_string, LocalsHack())
+            for k, v in attributes_dict.items():
+                if isinstance(k, ObjectHack):
+                    k = k._name # we assume non-variable keys
+                if isinstance(v, ObjectHack):
+                    v = '#{%s}' % v._name
+                attributes_dict[k] = v
+                if k != 'id' and k != 'class':
+                    if isinstance(v, NoneType):
+                        attributes += "%s " % (k,)
+                    elif isinstance(v, int) or isinstance(v, float):
+                        attributes += "%s='%s' " % (k, v)
+                    else:
+                        v = v.decode('utf-8')
+                        attributes += "%s='%s' " % (k, _legacy_escape_attribute_quotes(v))
+
+            # append conditional attributes
+            for attrname, check_type, condition in conditional_matches:
+                if check_type == "unless":
+                    check_type = "if not"
+                attributes += "{%% %s %s %%} %s{%% endif %%}" % (check_type, condition, attrname)
+
+            # append conditional presence attributes
+            for attrname, check_type, condition, value in conditional_presence_matches:
+                if check_type == "unless":
+                    check_type = "if not"
+                if re.compile(r"^'.+?'$", re.U).match(value) or re.compile(r'^".+?"$', re.U).match(value):
+                    value = _legacy_escape_attribute_quotes(value[1:-1])
+                else:
+                    value = "#{%s}" % value # value is variable
+                if attrname == "class":
+                    previous_value = attributes_dict.get("class")
+                    if previous_value:
+                        attributes_dict["class"] = "%s{%% %s %s %%} %s{%% endif %%}" % (previous_value, check_type, condition, value)
+                    else:
+                        attributes_dict["class"] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
+                else:
+                    if attributes_dict.get(attrname):
+                        raise Exception('multiple values are allowed only for `class`')
+                    if attrname == "id":
+                        attributes_dict[attrname] = "{%% %s %s %%}%s{%% endif %%}" % (check_type, condition, value)
+                    else:
+                        if not attributes.endswith(" "):
+                            attributes += " "
+                        attributes += "{%% %s %s %%}%s='%s'{%% endif %%}" % (check_type, condition, attrname, value)
+
+            # append tag call attributes
+            for attrname, tagname, arguments in tag_call_matches:
+                value = "{%% %s %s %%}" % (tagname, arguments)
+                if attrname is "class":
+                    previous_value = attributes_dict.get("class")
+                    if previous_value:
+                        attributes_dict["class"] = "%s %s" % (previous_value, value)
+                    else:
+                        attributes_dict["class"] = value
+                else:
+                    if attributes_dict.get(attrname):
+                        raise Exception('multiple values are allowed only for `class`')
+                    if not attributes.endswith(" "):
+                        attributes += " "
+                    attributes += "%s='%s'" % (attrname, value)
+
+            attributes = attributes.strip()
+        except Exception, e:
+            raise Exception('failed to decode: %s'%attribute_dict_string)
+
+    return attributes_dict, attributes
+
+
+def _decoded(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return type(value)(_decoded(item) for item in value)
+    return value
+
+
+# Attribute dictionaries both parsers understand
+DIFFERENTIAL_CASES = [
+    "{'a': 'b'}",
+    "{'a': 'b', 'c': 'd'}",
+    '{"a": "b", "c": 3, "d": None}',
+    "{a: 'b', c: 2, d: None}",
+    '''{style:"a:x, b:'y', c:1, d:\\"dk\\", e:3"}''',
+    '''{style:'a:x, b:\\'y\\', c:1, d:"dk", e:3'}''',
+    "{'data-url': 'something', 'class': 'blah'}",
+    "{'id': 'abc', 'class': 'x y', 'title': 'z'}",
+    "{'id': ['a', 'b'], 'class': ['c', 'd']}",
+    "{'id': ('a', 'b')}",
+    "{'class': ('c',)}",
+    "{'value': some.django_variable}",
+    "{'value': var, 'other': 'b'}",
+    "{'href': \"/posts/{{ post.id }}\"}",
+    "{'title': 'it\\'s'}",
+    "{'title': \"it's {% trans 'x' %}\"}",
+    "{'b': '\\\\={greeting} test'}",
+    "{'float': 1.5, 'int': 42}",
+    "{'value': 010, 'zero': 0, 'negative': -07, 'zeros': 00}",
+    "{:class => 'a', :title => 'b'}",
+    '{"data-x" => "y"}',
+    "{'a': 'b',\n 'c': 'd'}",
+    "{'x': 'y', checked: if(is_checked)}",
+    "{checked: unless(foo.bar), 'x': 1}",
+    "{'a': 'b', class: if(active, 'on')}",
+    "{class: unless(active, 'off')}",
+    "{id: if(anchor, anchor_name)}",
+    "{'class': 'base', class: if(active, 'on')}",
+    "{title: if(show, \"it's\")}",
+    "{'a': 'b', disabled: if(off), title: if(t, 'x')}",
+    "{href: url('blog', post.id)}",
+    "{href: url('blog', post.id), 'title': 'x'}",
+    "{data-id: if(x, 'y')}",
+    "{ 'a' : 'b' , 'c' : 'd' , }",
+    "{}",
+    u"{'title': '\u00e9t\u00e9'}",
+    "{'title': 'a' 'b'}",
+]
+
+
+class TestAttributeParser(object):
+
+    def test_matches_legacy_parser(self):
+        for case in DIFFERENTIAL_CASES:
+            legacy_dict, legacy_attributes = legacy_parse_attribute_dictionary(case)
+            attributes_dict, attributes = parse_attribute_dictionary(case)
+            eq_(dict((key, _decoded(value)) for key, value in legacy_dict.items()), attributes_dict, case)
+            eq_(_decoded(legacy_attributes), attributes, case)
+
+    def test_braces_and_calls_inside_strings_are_text(self):
+        attributes_dict, attributes = parse_attribute_dictionary("{'title': 'a, b: if(c)}', 'x': ':y => z'}")
+        eq_(attributes_dict, {'title': 'a, b: if(c)}', 'x': ':y => z'})
+
+    def test_keys_inside_strings_are_left_alone(self):
+        attributes_dict, _ = parse_attribute_dictionary("{'name': 'viewport', 'content': 'width:device-width, initial-scale:1'}")
+        eq_(attributes_dict['content'], 'width:device-width, initial-scale:1')
+
+    def test_conditions_may_use_any_operator(self):
+        _, attributes = parse_attribute_dictionary("{selected: if(a != b), title: if(x >= 1, 'y')}")
+        eq_(attributes, "{% if a != b %} selected{% endif %} {% if x >= 1 %}title='y'{% endif %}")
+
+    def test_several_tag_calls(self):
+        _, attributes = parse_attribute_dictionary("{href: url('blog'), src: static('img.png')}")
+        eq_(attributes, "href='{% url 'blog' %}' src='{% static 'img.png' %}'")
+
+    def test_values_are_never_evaluated(self):
+        attributes_dict, _ = parse_attribute_dictionary("{'a': __import__}")
+        eq_(attributes_dict['a'], '#{__import__}')
+
+    def test_variable_keys_and_values(self):
+        attributes_dict, _ = parse_attribute_dictionary("{class: foo.bar, data-id: item.pk}")
+        eq_(attributes_dict, {'class': '#{foo.bar}', 'data-id': '#{item.pk}'})
+
+    def test_unicode_values_stay_unicode(self):
+        attributes_dict, attributes = parse_attribute_dictionary(u"{'class': '\u00e9', 'title': u'\\u00e9'}")
+        eq_(attributes_dict['class'], u'\u00e9')
+        eq_(attributes, u"title='\u00e9'")
+
+    def test_call_arguments_may_contain_parentheses(self):
+        _, attributes = parse_attribute_dictionary("{href: url('a(b)', x)}")
+        eq_(attributes, "href='{% url 'a(b)', x %}'")
+
+    @raises(Exception)
+    def test_trailing_text_is_an_error(self):
+        parse_attribute_dictionary("{'a': 'b'} c")
+
+    @raises(Exception)
+    def test_invalid_octal_number_is_an_error(self):
+        parse_attribute_dictionary("{'value': 08}")
+
+    @raises(Exception)
+    def test_unterminated_string_is_an_error(self):
+        AttributeParser("{'a': 'b}").parse()
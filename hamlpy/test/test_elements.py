@@ -137,3 +137,18 @@ class TestElement(object):
             assert "href='/long/url/to/stylesheet/resource.css'" in sut.attributes
             assert "type='text/css'" in sut.attributes
             assert "rel='stylesheet'" in sut.attributes
+
+        def test_repeated_heads_are_parsed_once(self):
+            Element.head_cache.clear()
+            first = Element("%td.num{'title': 'x'} 1")
+            second = Element("%td.num{'title': 'x'} 2")
+            eq_(Element.head_cache.misses, 1)
+            eq_(Element.head_cache.hits, 1)
+            eq_(second.classes, 'num')
+            eq_(second.attributes, "title='x'")
+            eq_((first.inline_content, second.inline_content), ('1', '2'))
+
+        def test_head_without_attributes(self):
+            sut = Element("%li#_item.a.b= value")
+            eq_((sut.tag, sut.id, sut.classes, sut.attributes_dict), ('li', 'item', 'a b', {}))
+            assert sut.django_variable
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import re
+import unittest
+from nose.tools import eq_
+
+from hamlpy import hamlpy, typo
+from hamlpy.cache import LRUCache
+
+# Output of the rules applied one after the other, as typo did before they were merged
+CASES = [
+    (u"  много    пробелов  ", u"много пробелов"),
+    (u"слово(в скобках)слово", u"слово (в\u00a0скобках) слово"),
+    (u"( пробелы внутри )", u"(пробелы внутри)"),
+    (u"Ну и...", u"Ну и\u2026"),
+    (u"два.. точки", u"два. точки"),
+    (u"пробел , перед запятой !", u"пробел, перед\u00a0запятой!"),
+    (u"точка.Запятая,слово", u"точка. Запятая, слово"),
+    (u"В 2012 г. и 1990гг", u"В\u00a02012\u00a0г. и\u00a01990\u00a0гг."),
+    (u"цена $ 100 000", u"цена $\u00a0100\u00a0000"),
+    (u"слово - слово", u"слово\u00a0\u2014 слово"),
+    (u"т.е. и т. д.", u"т.\u00a0е. и\u00a0т.\u00a0д."),
+    (u"5 кг. веса", u"5\u00a0кг. веса"),
+    (u"Я и ты в доме", u"Я и\u00a0ты в\u00a0доме"),
+    (u"Из-за угла и из-под стола", u"Из-за\u00a0угла и\u00a0из-под\u00a0стола"),
+    (u"a&nbsp;b&mdash;c", u"a b-c"),
+    (u"x\u2013y \u2014 z", u"x-y\u00a0\u2014 z"),
+    (u"plain english text", u"plain english text"),
+    (u"", u""),
+]
+
+
+class TypoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.typo_cache = typo.typo_cache
+        typo.typo_cache = LRUCache(maxsize=4)
+
+    def tearDown(self):
+        typo.typo_cache = self.typo_cache
+
+    def test_rules(self):
+        for text, expected in CASES:
+            eq_(typo.typo(text), expected)
+
+    def test_requires_unicode(self):
+        self.assertRaises(RuntimeError, typo.typo, 'bytes')
+
+    def test_typo_many(self):
+        texts = [text for text, expected in CASES]
+        eq_(typo.typo_many(texts), [expected for text, expected in CASES])
+        eq_(len(typo.typo_cache), 4)
+
+    def test_typo_many_remembers_results(self):
+        eq_(typo.typo_many([u"Я и ты", u"Я и ты"]), [u"Я и\u00a0ты", u"Я и\u00a0ты"])
+        eq_((typo.typo_cache.hits, typo.typo_cache.misses), (1, 1))
+
+    def test_typo_node(self):
+        eq_(hamlpy.Compiler().process(u"~ Я и ты\n~ Я и ты"), u"Я и\u00a0ты\nЯ и\u00a0ты\n")
+        eq_(typo.typo_cache.hits, 1)
+
+
+class TypoHtmlStreamTest(unittest.TestCase):
+
+    def test_text_between_tags(self):
+        html = u'<p class="a">Я и ты <b>в</b> доме &amp; <br/> x...</p>'
+        eq_(typo.typo_html_stream(html), u'<p class="a">Я и\u00a0ты <b>в</b> доме &amp; <br/> x\u2026</p>')
+
+    def test_entities_are_typo_input(self):
+        eq_(typo.typo_html_stream(u'<p>a&nbsp;&nbsp;b&mdash;c &#1071; &#x42;</p>'), u'<p>a b-c Я B</p>')
+        eq_(typo.typo_html_stream(u'<p>&laquo;Привет&raquo;</p>'), u'<p>«Привет»</p>')
+
+    def test_text_is_escaped_after_typo(self):
+        eq_(typo.typo_html_stream(u'<p>&amp;Б &lt;b&gt; &nosuch;</p>'), u'<p>&amp;Б &lt;b&gt; &amp;nosuch;</p>')
+
+    def test_comments_are_stripped(self):
+        eq_(typo.typo_html_stream(u'<p>a<!-- b --></p>'), u'<p>a</p>')
+
+    def test_scripts_and_styles_are_copied(self):
+        html = u'<!DOCTYPE html><script>a  -  b</script><style>p  { }</style>'
+        eq_(typo.typo_html_stream(html), html)
+
+    def test_chunks(self):
+        chunks = iter([u'<p>Я и', u' ты</p', u'><p>', u'два.. точки</p>'])
+        eq_(typo.typo_html_stream(chunks), u'<p>Я и\u00a0ты</p><p>два. точки</p>')
+
+    def test_writes_to_out(self):
+        written = []
+        class Out(object):
+            write = written.append
+        chunks = (u'<p>%d...</p>' % i for i in range(1000))
+        eq_(typo.typo_html_stream(chunks, Out()), None)
+        eq_(u''.join(written), u''.join(u'<p>%d\u2026</p>' % i for i in range(1000)))
+
+    def test_requires_unicode(self):
+        self.assertRaises(RuntimeError, typo.typo_html_stream, '<p>bytes</p>')
+
+
+class RulesetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rulesets = dict(typo.rulesets)
+        self.typo_cache = typo.typo_cache
+        typo.typo_cache = LRUCache(maxsize=4)
+        typo.register_ruleset('en', typo.Ruleset([(r'\.{3}', u'\u2026', u'.')], ['a', 'an', 'the', 'e.g.', 'Mr.', 'et al.']))
+
+    def tearDown(self):
+        typo.rulesets.clear()
+        typo.rulesets.update(self.rulesets)
+        typo.typo_cache = self.typo_cache
+
+    def test_locale(self):
+        eq_(typo.typo(u'Mr. Smith saw a cat... and  the dog', 'en'),
+            u'Mr.\u00a0Smith saw a\u00a0cat\u2026 and  the\u00a0dog')
+        eq_(typo.typo(u'Я и ты', 'en'), u'Я и ты')
+
+    def test_default_locale(self):
+        eq_(typo.get_ruleset(), typo.get_ruleset('ru'))
+        eq_(typo.typo(u'Я и ты'), u'Я и\u00a0ты')
+
+    def test_unknown_locale(self):
+        self.assertRaises(RuntimeError, typo.typo, u'text', 'xx')
+
+    def test_glue_words_at_word_boundaries(self):
+        eq_(typo.typo(u'Shea ran, e.g. to Ithe, et al. said', 'en'), u'Shea ran, e.g.\u00a0to Ithe, et al.\u00a0said')
+        eq_(typo.typo(u'x-the end', 'en'), u'x-the\u00a0end')
+
+    def test_glue_pattern(self):
+        words = [u'в', u'из', u'из-за', u'из-под', u'от']
+        pattern = typo.glue_pattern(words)
+        alternation = re.compile(ur'\b(%s)\s' % u'|'.join(map(re.escape, words)), re.U)
+        text = u'Из-за в из-под из от-из от  вз из-заз из\tв'
+        eq_(pattern.sub(u'\\1_', text), alternation.sub(u'\\1_', text))
+
+    def test_typo_many_caches_per_locale(self):
+        eq_(typo.typo_many([u'a b', u'a b'], 'en'), [u'a\u00a0b', u'a\u00a0b'])
+        eq_(typo.typo_many([u'a b']), [u'a b'])
+        eq_((typo.typo_cache.hits, typo.typo_cache.misses), (1, 2))
+
+    def test_typo_node(self):
+        eq_(hamlpy.Compiler().process(u'~[en] the end\n~ the end'), u'the\u00a0end\nthe end\n')
+
+    def test_unknown_locale_prefix_is_plain_text(self):
+        eq_(hamlpy.Compiler().process(u'~[note] the end\n%p\n  ~[xx] a b'), u'~[note] the end\n<p>\n  ~[xx] a b\n</p>\n')
+
+    def test_typo_html_stream(self):
+        eq_(typo.typo_html_stream(u'<p>a <b>the end</b></p>', locale='en'), u'<p>a <b>the\u00a0end</b></p>')
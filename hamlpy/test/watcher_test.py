@@ -0,0 +1,243 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
+
+from hamlpy import hamlpy_watcher, inotify
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class PollingWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.destination)
+
+    def test_compiles_new_and_changed_templates(self):
+        os.mkdir(os.path.join(self.folder, 'sub'))
+        source = os.path.join(self.folder, 'sub', 'page.haml')
+        _write(source, '%p one')
+        hamlpy_watcher._watch_folder(self.folder, self.destination)
+        output = os.path.join(self.destination, 'sub', 'page.html')
+        eq_(_read(output), '<p>one</p>\n')
+
+        _write(source, '%p two')
+        os.utime(source, (1, os.stat(source).st_mtime + 10))
+        hamlpy_watcher._watch_folder(self.folder, self.destination)
+        eq_(_read(output), '<p>two</p>\n')
+
+    def test_recompiles_deleted_output(self):
+        _write(os.path.join(self.folder, 'page.haml'), '%p')
+        hamlpy_watcher._watch_folder(self.folder, self.destination)
+        output = os.path.join(self.destination, 'page.html')
+        os.remove(output)
+        hamlpy_watcher._watch_folder(self.folder, self.destination)
+        assert os.path.exists(output)
+
+    def test_lists_files_created_in_the_same_timestamp_tick(self):
+        now = int(time.time())
+        os.utime(self.folder, (now, now))
+        eq_(hamlpy_watcher._list_directory(self.folder), ([], []))
+        _write(os.path.join(self.folder, 'page.haml'), '%p')
+        os.utime(self.folder, (now, now))
+        eq_(hamlpy_watcher._list_directory(self.folder), ([], ['page.haml']))
+
+    def test_ignores_other_files(self):
+        _write(os.path.join(self.folder, 'notes.txt'), '%p')
+        _write(os.path.join(self.folder, '.#page.haml'), '%p')
+        hamlpy_watcher._watch_folder(self.folder, self.destination)
+        eq_(os.listdir(self.destination), [])
+
+
+class EventWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        if not inotify.available():
+            raise SkipTest('inotify is not available')
+        self.folder = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+        self.watcher = hamlpy_watcher.EventWatcher(self.folder, self.destination)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.destination)
+
+    def _wait_for(self, path):
+        for i in range(20):
+            if os.path.exists(path):
+                return
+            self.watcher.process_events(timeout=0.1)
+        self.fail('%s was not compiled' % path)
+
+    def test_compiles_written_template(self):
+        _write(os.path.join(self.folder, 'page.haml'), '%p one')
+        output = os.path.join(self.destination, 'page.html')
+        self._wait_for(output)
+        eq_(_read(output), '<p>one</p>\n')
+
+        _write(os.path.join(self.folder, 'page.haml'), '%p two')
+        self.watcher.process_events(timeout=1)
+        eq_(_read(output), '<p>two</p>\n')
+
+    def test_watches_new_folders(self):
+        os.makedirs(os.path.join(self.folder, 'a', 'b'))
+        _write(os.path.join(self.folder, 'a', 'b', 'page.haml'), '%p')
+        self._wait_for(os.path.join(self.destination, 'a', 'b', 'page.html'))
+
+        _write(os.path.join(self.folder, 'a', 'b', 'other.haml'), '%p')
+        self._wait_for(os.path.join(self.destination, 'a', 'b', 'other.html'))
+
+
+class ParallelBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+        self.pool = hamlpy_watcher._make_pool(2)
+
+    def tearDown(self):
+        self.pool.terminate()
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.destination)
+
+    def _build(self, pool):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            hamlpy_watcher._watch_folder(self.folder, self.destination, pool=pool)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_reports_in_the_same_order_as_a_serial_build(self):
+        for i in range(6):
+            _write(os.path.join(self.folder, 'page%d.haml' % i), '%%p %d' % i)
+        _write(os.path.join(self.folder, 'page3.haml'), '- endif')
+
+        parallel = self._build(self.pool)
+        eq_(_read(os.path.join(self.destination, 'page5.html')), '<p>5</p>\n')
+        hamlpy_watcher.compiled.clear()
+        hamlpy_watcher.manifests.clear()
+        os.remove(os.path.join(self.destination, hamlpy_watcher.Manifest.FILENAME))
+        serial = self._build(None)
+
+        strip_time = lambda report: [line[9:] if line[:2].isdigit() else line for line in report.splitlines()]
+        eq_(strip_time(parallel), strip_time(serial))
+        assert 'Failed to compile %s' % os.path.join(self.folder, 'page3.haml') in parallel
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'page.haml')
+        _write(self.source, '%p one')
+        self._restart()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.destination)
+
+    def _restart(self):
+        hamlpy_watcher.compiled.clear()
+        hamlpy_watcher.manifests.clear()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            hamlpy_watcher._watch_folder(self.folder, self.destination)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_restart_skips_unchanged_templates(self):
+        eq_(self._restart(), '')
+
+    def test_restart_skips_templates_that_were_only_touched(self):
+        os.utime(self.source, (1, os.stat(self.source).st_mtime + 10))
+        eq_(self._restart(), '')
+
+    def test_restart_compiles_changed_content(self):
+        _write(self.source, '%p two')
+        assert self._restart()
+        eq_(_read(os.path.join(self.destination, 'page.html')), '<p>two</p>\n')
+
+    def test_restart_compiles_modified_output(self):
+        _write(os.path.join(self.destination, 'page.html'), 'edited')
+        assert self._restart()
+        eq_(_read(os.path.join(self.destination, 'page.html')), '<p>one</p>\n')
+
+    def test_restart_compiles_after_upgrade(self):
+        manifest = hamlpy_watcher.manifests[self.destination]
+        for entry in manifest.entries.values():
+            entry['version'] = '0.1'
+        manifest.changed = True
+        manifest.save()
+        assert self._restart()
+
+
+class DependentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dependency_graph = hamlpy_watcher.dependency_graph
+        hamlpy_watcher.dependency_graph = hamlpy_watcher.DependencyGraph()
+        self.folder = tempfile.mkdtemp()
+        self.destination = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, 'partials'))
+        _write(os.path.join(self.folder, 'base.haml'), '%body\n  - block content')
+        _write(os.path.join(self.folder, 'partials', 'nav.haml'), '%nav')
+        _write(os.path.join(self.folder, 'page.haml'), '- extends "base.html"\n- block content\n  - include "partials/nav.html"')
+        _write(os.path.join(self.folder, 'other.haml'), '%p')
+        self._build()
+
+    def tearDown(self):
+        hamlpy_watcher.dependency_graph = self.dependency_graph
+        shutil.rmtree(self.folder)
+        shutil.rmtree(self.destination)
+
+    def _build(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            hamlpy_watcher._watch_folder(self.folder, self.destination)
+            return [line.split()[1] for line in sys.stdout.getvalue().splitlines()]
+        finally:
+            sys.stdout = stdout
+
+    def _change(self, *path):
+        source = os.path.join(self.folder, *path)
+        _write(source, _read(source) + '\n%p')
+        os.utime(source, (1, os.stat(source).st_mtime + 10))
+
+    def test_records_dependencies(self):
+        eq_(hamlpy_watcher.dependency_graph.dependencies('page'), set(['base', 'partials/nav']))
+
+    def test_changed_partial_compiles_dependents(self):
+        self._change('partials', 'nav.haml')
+        eq_(self._build(), [os.path.join(self.folder, 'partials', 'nav.haml'), os.path.join(self.folder, 'page.haml')])
+
+    def test_dependencies_survive_restart(self):
+        hamlpy_watcher.compiled.clear()
+        hamlpy_watcher.manifests.clear()
+        hamlpy_watcher.dependency_graph = hamlpy_watcher.DependencyGraph()
+        eq_(self._build(), [])
+        self._change('base.haml')
+        eq_(self._build(), [os.path.join(self.folder, 'base.haml'), os.path.join(self.folder, 'page.haml')])
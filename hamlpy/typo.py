@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import sys
 import codecs
+import hashlib
 import cStringIO
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 
-import html5lib
-from colorama import Fore, Back
+from cache import LRUCache
 
-from django.conf import settings
+# html5lib and colorama are imported when typo_html and the debug log are used
 
 
-__all__ = ("typo", "typo_html", )
+__all__ = ("typo", "typo_many", "typo_html", "typo_html_stream", "Ruleset", "register_ruleset", "get_ruleset", )
 
 
 def doublecase(*items):
@@ -113,47 +117,231 @@ general_substitutions = (
 )
 
 
+def _setting(name, default):
+    """Returns the Django setting `name`, or `default` when Django settings are not in use"""
+    conf = sys.modules.get("django.conf")
+    if conf is None:
+        return default
+    if not conf.settings.configured and not os.environ.get(conf.ENVIRONMENT_VARIABLE):
+        return default
+    return getattr(conf.settings, name, default)
+
+
 def sub_and_log_debug(regex, sub, data):
+    from colorama import Fore, Back
 
     def highlight_matches(match):
         return Back.MAGENTA + Fore.WHITE + match.group() + Back.RESET + Fore.RESET
 
+    def highlight_substitutions(match):
+        return Fore.WHITE + Back.CYAN + (sub(match) if callable(sub) else match.expand(sub)) + Fore.RESET + Back.RESET
+
     new_data = regex.sub(sub, data)
     if new_data != data:
         print "'%s%s%s' => %s%r%s" % (Fore.MAGENTA, regex.pattern, Fore.WHITE, Fore.CYAN, sub, Fore.RESET)
         print regex.sub(highlight_matches, data)
-        print regex.sub(Fore.WHITE + Back.CYAN + sub + Fore.RESET + Back.RESET, data)
+        print regex.sub(highlight_substitutions, data)
         print Back.RESET + Fore.RESET
 
     return new_data
 
 
-if settings.DEBUG and getattr(settings, "LOG_TYPO", False):
-    sub_and_log = sub_and_log_debug
-else:
-    sub_and_log = lambda regex, sub, data: regex.sub(sub, data)
+def _sub(regex, sub, data):
+    return regex.sub(sub, data)
+
+
+def sub_and_log(regex, sub, data):
+    """Replaces itself with sub_and_log_debug or _sub when first called, by then the settings are known"""
+    global sub_and_log
+    if _setting("DEBUG", False) and _setting("LOG_TYPO", False):
+        sub_and_log = sub_and_log_debug
+    else:
+        sub_and_log = _sub
+    return sub_and_log(regex, sub, data)
+
+
+def _replace_with(replacements):
+    """Substitution that looks the matched text up in `replacements`, for rules merged into one pattern"""
+    def replace(match):
+        text = match.group()
+        return replacements.get(text, text)
+    return replace
+
+
+def _replace_dots(match):
+    return u"\u2026" if len(match.group()) > 2 else u"."
+
+
+def _remove_inner_whitespace(match):
+    return match.group().strip()
+
+
+def _russian_rules():
+    """Returns the rules of the built-in "ru" ruleset as (regex, substitution, trigger characters) tuples.
+
+    Consecutive substitutions that cannot affect each other's matches are merged into a
+    single pattern, and a rule is skipped when the text has none of its trigger characters.
+    The result is the same as applying html_substitutions, the dash replacement and
+    general_substitutions one after the other.
+    """
+    general = dict(general_substitutions)
+    def rule(pattern, sub=None, triggers=None):
+        return re.compile(pattern, re.U), general[pattern] if sub is None else sub, triggers
+
+    entities = dict(html_substitutions)
+    entities.update((dash, u"-") for dash in dashes)
+
+    return [
+        # html entities and unicode dashes
+        rule(u"|".join(map(re.escape, entities)), _replace_with(entities), u"&" + u"".join(dashes)),
+        rule(ur"\s{2,}"),
+        # whitespace around parenthesis, then inside them
+        rule(ur"(?<=\w)\(|\)(?=\w)", _replace_with({u"(": u" (", u")": u") "}), u"()"),
+        rule(ur"\(\s(?=\w)|(?<=\w)\s\)", _remove_inner_whitespace, u"()"),
+        # three or more dots, then two dots
+        rule(ur"\.{3,}|\.\.", _replace_dots, u"."),
+        rule(ur"\s(?=\.|\,|\:|\;|\!|\?)", None, u".,:;!?"),
+        # whitespace after punctuation and after dots
+        rule(ur"(?<=\,|\:|\;|\!|\?|\.)(?=[а-яА-Я])", u" ", u".,:;!?"),
+        rule(ur"(\d{4})\s?(гг?)(?:\.|\b)", None, u"г"),
+        rule(ur"(?<=[\d$])\s(?=\d)"),
+        rule(ur"(?:\s-\s?|\s?-\s)", None, u"-"),
+        rule(ur"(\b\w{1,3})\.\s?(\w{1,3}\b)\.", None, u"."),
+        rule(ur"(?<=\d)\s(?=\w{1,3}\.)", None, u"."),
+    ]
+
+
+def _trie_pattern(node):
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char is not None]
+    if not branches:
+        return u""
+    if len(branches) == 1 and None not in node:
+        return branches[0]
+    pattern = u"(?:%s)" % u"|".join(branches)
+    if None in node:
+        pattern += u"?"
+    return pattern
+
+
+def glue_pattern(words):
+    """Returns the regex matching any of `words` at a word boundary followed by a whitespace.
+
+    The words are merged into a trie and written out as nested groups, "и(?:з(?:-(?:за|под))?)?"
+    for "и", "из", "из-за" and "из-под", so matching at a position costs at most the length of
+    the longest word instead of trying every word in turn like an alternation of them would.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[None] = True
+    return re.compile(ur"\b(%s)\s" % _trie_pattern(trie), re.U)
+
+
+class Ruleset(object):
+    """The typography rules of a language.
+
+    `rules` are (pattern, substitution, trigger characters) tuples applied in order, a rule
+    being skipped when the text has none of its trigger characters (None to always apply it).
+    `glue_words`, such as prepositions and abbreviations, are then glued to the next word
+    with a non-breaking space.
+    """
+
+    def __init__(self, rules=(), glue_words=()):
+        self.rules = [(re.compile(pattern, re.U) if isinstance(pattern, basestring) else pattern, sub, triggers)
+                      for pattern, sub, triggers in rules]
+        if glue_words:
+            self.rules.append((glue_pattern(glue_words), u"\\1\u00a0", None))
+
+    def fingerprint(self):
+        """A digest of the rules, the same in every process"""
+        digest = hashlib.sha1()
+        for regex, sub, triggers in self.rules:
+            digest.update(repr((regex.pattern, getattr(sub, "__name__", sub), triggers)))
+        return digest.hexdigest()
+
+    def typo(self, data):
+        data = data.strip()
+        for regex, sub, triggers in self.rules:
+            if triggers is None or any(char in data for char in triggers):
+                data = sub_and_log(regex, sub, data)
+        return data.strip()
+
+
+DEFAULT_LOCALE = "ru"
+
+def _russian_ruleset():
+    return Ruleset(_russian_rules(), simple_prepositions)
+
+
+# Rulesets by locale, or functions that make them when first used
+rulesets = {
+    "ru": _russian_ruleset,
+}
+
+# Rulesets made by the functions in `rulesets`, by locale
+_made_rulesets = {}
+
+
+def register_ruleset(locale, ruleset):
+    """Makes `ruleset`, a Ruleset or a function returning one, the ruleset of `locale`"""
+    rulesets[locale] = ruleset
+    _made_rulesets.pop(locale, None)
+    typo_cache.clear()
+
+
+def get_ruleset(locale=None):
+    """Returns the ruleset of `locale`, by default of the HAMLPY_TYPO_LOCALE setting (DEFAULT_LOCALE if unset)"""
+    if locale is None:
+        locale = _setting("HAMLPY_TYPO_LOCALE", DEFAULT_LOCALE)
+    try:
+        ruleset = rulesets[locale]
+    except KeyError:
+        raise RuntimeError("no typography ruleset for locale %r" % locale)
+    if not isinstance(ruleset, Ruleset):
+        factory = ruleset
+        ruleset = _made_rulesets.get(locale)
+        if ruleset is None:
+            ruleset = _made_rulesets[locale] = factory()
+    return ruleset
+
+
+def rulesets_fingerprint():
+    """Describes the default locale and the registered rulesets, the same way in every process"""
+    parts = [_setting("HAMLPY_TYPO_LOCALE", DEFAULT_LOCALE)]
+    for locale, ruleset in sorted(rulesets.items()):
+        if isinstance(ruleset, Ruleset):
+            parts.append((locale, ruleset.fingerprint()))
+        else:
+            parts.append((locale, "%s.%s" % (ruleset.__module__, ruleset.__name__)))
+    return repr(parts)
 
 
-def typo(data):
+def typo(data, locale=None):
     if data and not isinstance(data, unicode):
         raise RuntimeError("`typo` requires unicode")
+    return get_ruleset(locale).typo(data)
 
-    # prepare input - remove html entities and replace
-    # unicode dashes to default one
-    data = data.strip()
-    for entity, sub in html_substitutions:
-        data = data.replace(entity, sub)
-    data = sub_and_log(re.compile(ur"(?:%s)" % "|".join(dashes), re.U), "-", data)
 
-    for pattern, sub in general_substitutions:
-        regex = re.compile(pattern, re.U)
-        data = sub_and_log(regex, sub, data)
+# Results of typo_many, keyed on the locale and the input text
+typo_cache = LRUCache(maxsize=1024)
 
-    pattern = ur"\b(%s)\s" % "|".join(simple_prepositions)
-    regex = re.compile(pattern, re.U)
-    data = sub_and_log(regex, u"\\1\u00a0", data)
 
-    return data.strip()
+def _typo_cached(data, locale):
+    key = (locale, data)
+    result = typo_cache.get(key)
+    if result is None:
+        result = typo(data, locale)
+        typo_cache.set(key, result)
+    return result
+
+
+def typo_many(texts, locale=None):
+    """Returns typo(text, locale) for each text, remembering the results for the texts seen most recently"""
+    if locale is None:
+        locale = _setting("HAMLPY_TYPO_LOCALE", DEFAULT_LOCALE)
+    return [_typo_cached(data, locale) for data in texts]
 
 
 def quoteattr(value):
@@ -186,8 +374,9 @@ class Tag(object):
 
 class TypoWalker(object):
 
-    def __init__(self, fragment, out):
+    def __init__(self, fragment, out, locale=None):
         self.out = codecs.getwriter('utf-8')(out)
+        self.locale = _setting("HAMLPY_TYPO_LOCALE", DEFAULT_LOCALE) if locale is None else locale
         for child in fragment.childNodes:
             self.visit(child)
 
@@ -200,7 +389,7 @@ class TypoWalker(object):
             # add leading whitespace as is
             if node.value.startswith(" "):
                 self.out.write(" ")
-            self.out.write(typo(node.value))
+            self.out.write(_typo_cached(node.value, self.locale))
         elif node.type is 6:
             # strip comments
             pass
@@ -208,14 +397,132 @@ class TypoWalker(object):
             raise RuntimeError("unknown node type %r" % node.type)
 
 
-def typo_html(data, out=None):
+def typo_html(data, out=None, locale=None):
     if data and not isinstance(data, unicode):
         raise RuntimeError("`typo_html` requires unicode")
     return_value = False
     if not out:
         out = cStringIO.StringIO()
         return_value = True
+    import html5lib
     fragment = html5lib.parseFragment(data)
-    TypoWalker(fragment, out)
+    TypoWalker(fragment, out, locale)
     if return_value:
         return out.getvalue()
+
+
+def _escape_text(text):
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+
+class TypoStreamParser(HTMLParser):
+    """Applies `typo` to the text between tags and copies everything else through, writing
+    to `write` as it goes. Only the text since the last tag is held in memory."""
+
+    # Elements whose content is copied as is
+    RAW_TEXT_ELEMENTS = ("script", "style")
+
+    def __init__(self, write, locale=None):
+        HTMLParser.__init__(self)
+        self.write = write
+        self.ruleset = get_ruleset(locale)
+        self.text = []
+        self.raw_text = False
+
+    def flush_text(self):
+        if not self.text:
+            return
+        data = u"".join(self.text)
+        del self.text[:]
+        if self.raw_text:
+            self.write(data)
+            return
+        typo_data = _escape_text(self.ruleset.typo(data))
+        # keep a separating whitespace on either side, like typo_html does before the text
+        if data[:1].isspace():
+            self.write(u" ")
+        self.write(typo_data)
+        if data[-1:].isspace() and typo_data:
+            self.write(u" ")
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        self.write(self.get_starttag_text())
+        if tag in self.RAW_TEXT_ELEMENTS:
+            self.raw_text = True
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush_text()
+        self.write(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        self.write(u"</%s>" % tag)
+        if tag in self.RAW_TEXT_ELEMENTS:
+            self.raw_text = False
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        # decoded so that typo sees the characters, the text is escaped again when written
+        if name in name2codepoint:
+            self.text.append(unichr(name2codepoint[name]))
+        else:
+            self.text.append(u"&%s;" % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in u"xX":
+                self.text.append(unichr(int(name[1:], 16)))
+            else:
+                self.text.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            self.text.append(u"&#%s;" % name)
+
+    def handle_comment(self, data):
+        # strip comments
+        self.flush_text()
+
+    def handle_decl(self, decl):
+        self.flush_text()
+        self.write(u"<!%s>" % decl)
+
+    def handle_pi(self, data):
+        self.flush_text()
+        self.write(u"<?%s>" % data)
+
+    def unknown_decl(self, data):
+        self.flush_text()
+        self.write(u"<![%s]>" % data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self.flush_text()
+
+
+def typo_html_stream(data, out=None, locale=None):
+    """Like typo_html, but `data` is read as a stream of tokens instead of being parsed into a tree,
+    so memory use does not grow with the size of the document. `data` is a unicode string or an
+    iterable of unicode chunks, such as a file opened with codecs.open. Tags are copied unchanged
+    instead of being normalized, entities are decoded before typo and only &, < and > are escaped
+    again. The unicode result is written to `out` if given,
+    otherwise it is returned."""
+    if isinstance(data, basestring):
+        data = [data]
+    chunks = None
+    if out is None:
+        chunks = []
+        write = chunks.append
+    else:
+        write = out.write
+
+    parser = TypoStreamParser(write, locale)
+    for chunk in data:
+        if chunk and not isinstance(chunk, unicode):
+            raise RuntimeError("`typo_html_stream` requires unicode")
+        parser.feed(chunk)
+    parser.close()
+
+    if chunks is not None:
+        return u"".join(chunks)